@@ -22,10 +22,44 @@
 # Compatible with MaterialX Specs v1.33
 # http://www.materialx.org
 
+import Queue
+import array
+import bz2
+import cStringIO
 import collections
+import contextlib
+import copy
 import difflib
+import fnmatch
+import gc
+import hashlib
+import json
+import mmap
+import multiprocessing
+import os
+import random
+import re
 import string
+import struct
+import sys
+import tempfile
+import threading
+import time
+import weakref
 import xml.dom.minidom
+import xml.parsers.expat
+import xml.sax.saxutils
+import zlib
+
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 import unittest
 
@@ -66,6 +100,11 @@ kCollectionTag = 'collection'
 kCollectionAddTag = 'collectionadd'
 
 kParameterTag = 'parameter'
+kInputTag = 'input'
+kOutputTag = 'output'
+
+kOpGraphTag = 'opgraph'
+kConstantTag = 'constant'
 
 kGeomInfoTag = 'geominfo'
 kGeomAttrTag = 'geomattr'
@@ -80,23 +119,72 @@ kMaterialTag = 'material'
 kLookTag = 'look'
 kMaterialXTag = 'materialx'
 
+# Kinds of change reported to observers. kOrderChanged reports that the
+# children of an element were reordered, with the new keys as new.
+kChildChanged = 'child'
+kAttributeChanged = 'attribute'
+kValueChanged = 'value'
+kOrderChanged = 'order'
+
 #
 #
 class Object(object):
 
+    _observers = None
+
     def __init__(self):
         pass
 
     def getTypeName(self):
         pass
 
+    # Observers get objectChanged(obj, kind, key, old, new) for every change
+    # made directly to this object. Without observers a change only costs a
+    # check of _observers, _startObserving()/_stopObserving() set up and tear
+    # down whatever else the object needs while it is observed.
+    def addObserver(self, observer):
+        if self._observers is None:
+            self._observers = []
+            self._startObserving()
+        if not observer in self._observers:
+            self._observers.append(observer)
+
+    def removeObserver(self, observer):
+        if self._observers and observer in self._observers:
+            self._observers.remove(observer)
+            if not self._observers:
+                del self._observers
+                self._stopObserving()
+
+    def _startObserving(self):
+        pass
+
+    def _stopObserving(self):
+        pass
+
+    def _notify(self, kind, key, old, new):
+        for observer in list(self._observers):
+            observer.objectChanged(self, kind, key, old, new)
+
 #
 class Attribute(Object):
 
+    # Writes go straight to the instance dict, so that constructing an
+    # attribute does not go through __setattr__ below.
     def __init__(self, name, required = False, value = None):
-        self.name = name
-        self.required = required
-        self.value = value
+        d = self.__dict__
+        d['name'] = name
+        d['required'] = required
+        d['value'] = value
+
+    def __setattr__(self, name, value):
+        if self._observers and name == 'value':
+            old = self.__dict__.get('value')
+            self.__dict__['value'] = value
+            if not old is value:
+                self._notify(kValueChanged, self.name, old, value)
+        else:
+            self.__dict__[name] = value
 
     def getTypeName(self):
         pass
@@ -104,6 +192,9 @@ class Attribute(Object):
     def fromString(self, x):
         pass
 
+    def __reduce__(self):
+        return (self.__class__, (self.name, self.required, self.value))
+
     def __str__(self):
         if isinstance(self.value, list) or isinstance(self.value, tuple):
             return ','.join(str(x) for x in self.value)
@@ -354,12 +445,75 @@ class StringArrayAttribute(Attribute):
         a = a.replace('\,', ',')
         self.value = map(lambda x : str(x), a.split(','))
 
+# The attributes and children of an Element, notifying the element's
+# observers when items are set or removed. The element is only referenced
+# while it is observed, and then weakly, so elements stay free of cycles.
+class ElementDict(collections.OrderedDict):
+
+    _owner = None
+
+    def __observed(self):
+        owner = self._owner()
+        if owner is not None and owner._observers:
+            return owner
+
+        return None
+
+    def __setitem__(self, key, value, setitem = collections.OrderedDict.__setitem__):
+        if self._owner is None:
+            return setitem(self, key, value)
+
+        owner = self.__observed()
+        old = self.get(key)
+        setitem(self, key, value)
+        if owner is not None and not old is value:
+            owner._notify(self._kind, key, old, value)
+
+    def __delitem__(self, key, delitem = collections.OrderedDict.__delitem__):
+        if self._owner is None:
+            return delitem(self, key)
+
+        owner = self.__observed()
+        old = self[key]
+        delitem(self, key)
+        if owner is not None:
+            owner._notify(self._kind, key, old, None)
+
+    def clear(self):
+        owner = self.__observed() if self._owner is not None else None
+        items = self.items() if owner is not None else ()
+        collections.OrderedDict.clear(self)
+        for (key, old) in items:
+            owner._notify(self._kind, key, old, None)
+
+    # Moves the given keys, in order, after all others. Observers see a
+    # single kOrderChanged rather than the items being removed and added.
+    def reorder(self, keys, setitem = collections.OrderedDict.__setitem__, delitem = collections.OrderedDict.__delitem__):
+        for key in keys:
+            value = self[key]
+            delitem(self, key)
+            setitem(self, key, value)
+
+        owner = self.__observed() if self._owner is not None else None
+        if owner is not None:
+            owner._notify(kOrderChanged, None, None, self.keys())
+
 #
 class Element(Object):
 
     def __init__(self):
-        self.attributes = collections.OrderedDict()
-        self.children = collections.OrderedDict()
+        self.attributes = ElementDict()
+        self.children = ElementDict()
+
+    def _startObserving(self):
+        for (d, kind) in ((self.attributes, kAttributeChanged), (self.children, kChildChanged)):
+            d._owner = weakref.ref(self)
+            d._kind = kind
+
+    def _stopObserving(self):
+        for d in (self.attributes, self.children):
+            d.__dict__.pop('_owner', None)
+            d.__dict__.pop('_kind', None)
 
     def getTypeName(self):
         pass
@@ -389,6 +543,17 @@ class Element(Object):
 
         return thisXmlNode
 
+    # Pickles go through flattenElement(), copy.copy() stays shallow and
+    # shares the attributes and children, without the observers.
+    def __reduce__(self):
+        return (unflattenElement, (flattenElement(self),))
+
+    def __copy__(self):
+        copy = self.__class__.__new__(self.__class__)
+        copy.__dict__.update((k, v) for (k, v) in self.__dict__.iteritems() if k != '_observers')
+
+        return copy
+
 #
 class GeomInfo(Element):
 
@@ -535,7 +700,10 @@ class OpGraph(Element):
         self.attributes[kNameTag] = StringAttribute(kNameTag, True, name)
 
     def getTypeName(self):
-        return 'opgraph'
+        return kOpGraphTag
+
+    def compile(self):
+        return OpGraphProgram(self)
 
 #
 class Constant(Element):
@@ -548,7 +716,56 @@ class Constant(Element):
         self.attributes[kTypeTag] = StringAttribute(kTypeTag, True, ptype)
 
     def getTypeName(self):
-        return 'constant'
+        return kConstantTag
+
+#
+class OpNode(Element):
+
+    def __init__(self, category = '', name = '', ptype = ''):
+        Element.__init__(self)
+
+        self.category = category
+
+        #
+        self.attributes[kNameTag] = StringAttribute(kNameTag, True, name)
+        self.attributes[kTypeTag] = StringAttribute(kTypeTag, True, ptype)
+
+    def getTypeName(self):
+        return self.category
+
+    def fromXmlNode(self, xmlNode):
+        self.category = xmlNode.nodeName
+
+        super(OpNode, self).fromXmlNode(xmlNode)
+
+#
+class Input(Element):
+
+    def __init__(self, name = '', ptype = '', nodename = None, value = None):
+        Element.__init__(self)
+
+        #
+        self.attributes[kNameTag] = StringAttribute(kNameTag, True, name)
+        self.attributes[kTypeTag] = StringAttribute(kTypeTag, True, ptype)
+        self.attributes['nodename'] = StringAttribute('nodename', False, nodename)
+        self.attributes[kValueTag] = StringAttribute(kValueTag, False, value)
+
+    def getTypeName(self):
+        return kInputTag
+
+#
+class Output(Element):
+
+    def __init__(self, name = '', ptype = '', nodename = ''):
+        Element.__init__(self)
+
+        #
+        self.attributes[kNameTag] = StringAttribute(kNameTag, True, name)
+        self.attributes[kTypeTag] = StringAttribute(kTypeTag, True, ptype)
+        self.attributes['nodename'] = StringAttribute('nodename', True, nodename)
+
+    def getTypeName(self):
+        return kOutputTag
 
 #
 class Material(Element):
@@ -672,6 +889,19 @@ class MaterialX(Element):
                 self.__CreateNodeRecursively(childXmlNode, geominfoNode)
             elif childNodeName == kGeomAttrTag:
                 geomAttrNode = self.__CreateTypedNode(childXmlNode, GeomAttr, container)
+            elif childNodeName == kOpGraphTag:
+                opGraphNode = self.__CreateTypedNode(childXmlNode, OpGraph, container)
+                self.__CreateNodeRecursively(childXmlNode, opGraphNode)
+            elif childNodeName == kConstantTag:
+                constantNode = self.__CreateTypedNode(childXmlNode, Constant, container)
+                self.__CreateNodeRecursively(childXmlNode, constantNode)
+            elif childNodeName == kInputTag:
+                inputNode = self.__CreateTypedNode(childXmlNode, Input, container)
+            elif childNodeName == kOutputTag:
+                outputNode = self.__CreateTypedNode(childXmlNode, Output, container)
+            elif isinstance(container, OpGraph) and childXmlNode.nodeType == childXmlNode.ELEMENT_NODE:
+                opNode = self.__CreateTypedNode(childXmlNode, OpNode, container)
+                self.__CreateNodeRecursively(childXmlNode, opNode)
 
     def fromXmlNode(self, xmlNode):
         assert(xmlNode.nodeName == self.getTypeName())
@@ -683,14 +913,1892 @@ class MaterialX(Element):
         #
         self.__CreateNodeRecursively(xmlNode, self)
 
+    def read(self, path):
+        with open(path, 'rb') as f:
+            if f.read(len(kContainerMagic)) == kContainerMagic:
+                MaterialXContainer(f).readInto(self)
+                return
+
+            f.seek(0)
+            data = f.read()
+
+        self.fromXmlNode(xml.dom.minidom.parseString(data).documentElement)
+
+    def write(self, path, codec = None, chunkSize = None):
+        if codec is not None:
+            writeMaterialXContainer(self, path, codec, chunkSize or kContainerChunkSize)
+            return
+
+        data = str(self)
+        with open(path, 'wb') as f:
+            f.write(data)
+
     def __str__(self):
         #
         xmlDoc = xml.dom.minidom.Document()
         xmlDoc.appendChild(self.toXmlNode(xmlDoc))
         return xmlDoc.toprettyxml()
 
+#
+#
+kFlatNone = -1
+kFlatRaw = -2
+
+kFlatElementState = ('attributes', 'children', '_observers')
+
+kSharedMemoryDir = '/dev/shm' if os.path.isdir('/dev/shm') else None
+
+# Flattens an element tree into (types, strings, values, structure), where
+# structure is an integer array holding, in pre-order, for every element:
+#   type, key, extra instance state, attribute count, child count,
+#   then (key, type, name, required, value) for each of its attributes.
+# Strings are interned in 'strings'; value references >= 0 index 'strings',
+# kFlatNone is None and anything below kFlatRaw indexes 'values'.
+def flattenElement(element):
+    types = []
+    typeIndices = {}
+    strings = []
+    stringIndices = {}
+    values = []
+    structure = array.array('i')
+
+    def typeRef(t):
+        index = typeIndices.get(t)
+        if index is None:
+            index = typeIndices[t] = len(types)
+            types.append(t)
+        return index
+
+    def valueRef(v):
+        if v is None:
+            return kFlatNone
+
+        if isinstance(v, basestring):
+            key = (v.__class__, v)
+            index = stringIndices.get(key)
+            if index is None:
+                index = stringIndices[key] = len(strings)
+                strings.append(v)
+            return index
+
+        values.append(v)
+        return kFlatRaw - (len(values) - 1)
+
+    def flatten(key, element):
+        extra = dict((k, v) for (k, v) in element.__dict__.iteritems() if not k in kFlatElementState)
+        structure.extend((typeRef(element.__class__), valueRef(key), valueRef(extra or None),
+            len(element.attributes), len(element.children)))
+
+        for (attrKey, attr) in element.attributes.iteritems():
+            if attr is None:
+                structure.extend((valueRef(attrKey), kFlatNone, kFlatNone, 0, kFlatNone))
+            elif isinstance(attr, Attribute):
+                structure.extend((valueRef(attrKey), typeRef(attr.__class__),
+                    valueRef(attr.name), int(attr.required), valueRef(attr.value)))
+            else:
+                structure.extend((valueRef(attrKey), kFlatRaw, kFlatNone, 0, valueRef(attr)))
+
+        for (childKey, child) in element.children.iteritems():
+            flatten(childKey, child)
+
+    flatten(None, element)
+
+    return (types, strings, values, structure)
+
+def unflattenElement(data):
+    (types, strings, values, structure) = data
+    it = iter(structure)
+
+    def value(ref):
+        if ref >= 0:
+            return strings[ref]
+        elif ref == kFlatNone:
+            return None
+        else:
+            return values[kFlatRaw - ref]
+
+    def unflatten():
+        elementType = types[next(it)]
+        key = value(next(it))
+        extra = value(next(it))
+        attrCount = next(it)
+        childCount = next(it)
+
+        element = elementType.__new__(elementType)
+        Element.__init__(element)
+        if extra is not None:
+            element.__dict__.update(extra)
+
+        for i in xrange(attrCount):
+            (attrKey, attrType, attrName, required, attrValue) = (next(it), next(it), next(it), next(it), next(it))
+            if attrType == kFlatNone:
+                attr = None
+            elif attrType == kFlatRaw:
+                attr = value(attrValue)
+            else:
+                attr = types[attrType](value(attrName), bool(required), value(attrValue))
+            element.attributes[value(attrKey)] = attr
+
+        for i in xrange(childCount):
+            (childKey, child) = unflatten()
+            element.children[childKey] = child
+
+        return (key, element)
+
+    return unflatten()[1]
+
+# A MaterialX document pickled once into a shared memory segment, so a pool
+# of worker processes does not pickle and send the document with every task.
+# The handle itself is small and cheap to pass as a task argument. Each
+# worker still unpickles its own private copy, once, on the first attach().
+# The segment outlives the process unless unlink() is called, so prefer
+# using the handle as a context manager in the process that created it.
+class SharedMaterialX(object):
+
+    __attached = {}
+
+    def __init__(self, mtlx, directory = kSharedMemoryDir):
+        (fd, self.path) = tempfile.mkstemp('.mtlx', 'materialxs-', directory)
+        with os.fdopen(fd, 'wb') as f:
+            pickle.dump(mtlx, f, pickle.HIGHEST_PROTOCOL)
+            self.size = f.tell()
+
+    def attach(self):
+        mtlx = SharedMaterialX.__attached.get(self.path)
+        if mtlx is None:
+            with open(self.path, 'rb') as f:
+                buf = mmap.mmap(f.fileno(), self.size, access = mmap.ACCESS_READ)
+            try:
+                mtlx = pickle.load(buf)
+            finally:
+                buf.close()
+
+            SharedMaterialX.__attached[self.path] = mtlx
+
+        return mtlx
+
+    def detach(self):
+        SharedMaterialX.__attached.pop(self.path, None)
+
+    def unlink(self):
+        self.detach()
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.unlink()
+
+#
+def parseMaterialX(data):
+    if data.startswith(kContainerMagic):
+        return MaterialXContainer(cStringIO.StringIO(data)).read()
+
+    mtlx = MaterialX()
+    mtlx.fromXmlNode(xml.dom.minidom.parseString(data).documentElement)
+
+    return mtlx
+
+def loadMaterialX(path):
+    mtlx = MaterialX()
+    mtlx.read(path)
+
+    return mtlx
+
+#
+class CancelledError(Exception):
+    pass
+
+#
+class MaterialXFuture(object):
+
+    def __init__(self, path):
+        self.path = path
+        self.__lock = threading.Lock()
+        self.__event = threading.Event()
+        self.__state = 'pending'
+        self.__result = None
+        self.__error = None
+
+    def cancel(self):
+        with self.__lock:
+            if self.__state != 'pending':
+                return self.__state == 'cancelled'
+            self.__state = 'cancelled'
+
+        self.__event.set()
+        return True
+
+    def cancelled(self):
+        return self.__state == 'cancelled'
+
+    def done(self):
+        return self.__event.is_set()
+
+    def result(self, timeout = None):
+        if not self.__event.wait(timeout):
+            raise RuntimeError('timed out waiting for ' + self.path)
+        if self.__state == 'cancelled':
+            raise CancelledError(self.path)
+        if self.__error is not None:
+            raise self.__error
+
+        return self.__result
+
+    def _start(self):
+        with self.__lock:
+            if self.__state != 'pending':
+                return False
+            self.__state = 'running'
+
+        return True
+
+    def _finish(self, result, error = None):
+        self.__result = result
+        self.__error = error
+        self.__state = 'finished'
+        self.__event.set()
+
+# Overlaps reading and writing of many .mtlx files on a bounded set of I/O
+# threads. With processes > 0 the XML parsing is offloaded to a process pool,
+# parsed documents come back through the compact pickle form.
+# At most maxPending requests are in flight, further submissions block.
+class MaterialXExecutor(object):
+
+    def __init__(self, workers = 4, maxPending = 32, processes = 0):
+        self.__queue = Queue.Queue()
+        self.__slots = threading.BoundedSemaphore(maxPending)
+        self.__pending = set()
+        self.__pool = None
+        if processes > 0:
+            self.__pool = multiprocessing.Pool(processes)
+
+        self.__threads = []
+        for i in xrange(workers):
+            thread = threading.Thread(target = self.__run)
+            thread.daemon = True
+            thread.start()
+            self.__threads.append(thread)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, excType, excValue, traceback):
+        self.close(cancel = excType is not None)
+
+    def load(self, path):
+        return self.__submit(MaterialXFuture(path), self.__load, (path,))
+
+    def write(self, mtlx, path):
+        return self.__submit(MaterialXFuture(path), mtlx.write, (path,))
+
+    def cancel(self):
+        for future in list(self.__pending):
+            future.cancel()
+
+    def close(self, cancel = False):
+        if cancel:
+            self.cancel()
+
+        for thread in self.__threads:
+            self.__queue.put(None)
+        for thread in self.__threads:
+            thread.join()
+        self.__threads = []
+
+        if self.__pool is not None:
+            self.__pool.close()
+            self.__pool.join()
+            self.__pool = None
+
+    def __submit(self, future, function, args):
+        self.__slots.acquire()
+        self.__pending.add(future)
+        self.__queue.put((future, function, args))
+
+        return future
+
+    def __load(self, path):
+        if self.__pool is None:
+            return loadMaterialX(path)
+
+        with open(path, 'rb') as f:
+            data = f.read()
+
+        return self.__pool.apply(parseMaterialX, (data,))
+
+    def __run(self):
+        while True:
+            item = self.__queue.get()
+            if item is None:
+                break
+
+            (future, function, args) = item
+            try:
+                if future._start():
+                    try:
+                        future._finish(function(*args))
+                    except Exception as e:
+                        future._finish(None, e)
+            finally:
+                self.__pending.discard(future)
+                self.__slots.release()
+
+def gatherLoad(paths, workers = 4, maxPending = 32, processes = 0):
+    with MaterialXExecutor(workers, maxPending, processes) as executor:
+        futures = [executor.load(path) for path in paths]
+
+        return [future.result() for future in futures]
+
+#
+#
+kTypeChannels = {
+    kIntegerTag : 1,
+    kBooleanTag : 1,
+    kFloatTag : 1,
+    kColor2Tag : 2,
+    kColor3Tag : 3,
+    kColor4Tag : 4,
+    kVector2Tag : 2,
+    kVector3Tag : 3,
+    kVector4Tag : 4,
+}
+
+# Operator category : (input names, input defaults, function, commutative).
+# Functions work on whole arrays, a (channels,) constant broadcasts against
+# a (count, channels) stream.
+kOpGraphOperators = {
+    'add' : (('in1', 'in2'), (0.0, 0.0), lambda a, b: a + b, True),
+    'subtract' : (('in1', 'in2'), (0.0, 0.0), lambda a, b: a - b, False),
+    'multiply' : (('in1', 'in2'), (1.0, 1.0), lambda a, b: a * b, True),
+    'divide' : (('in1', 'in2'), (1.0, 1.0), lambda a, b: a / b, False),
+    'modulo' : (('in1', 'in2'), (0.0, 1.0), lambda a, b: numpy.mod(a, b), False),
+    'power' : (('in1', 'in2'), (0.0, 1.0), lambda a, b: numpy.power(a, b), False),
+    'min' : (('in1', 'in2'), (0.0, 0.0), lambda a, b: numpy.minimum(a, b), True),
+    'max' : (('in1', 'in2'), (0.0, 0.0), lambda a, b: numpy.maximum(a, b), True),
+    'dotproduct' : (('in1', 'in2'), (0.0, 0.0), lambda a, b: (a * b).sum(axis = -1, keepdims = True), True),
+    'absval' : (('in',), (0.0,), lambda a: numpy.abs(a), False),
+    'floor' : (('in',), (0.0,), lambda a: numpy.floor(a), False),
+    'ceil' : (('in',), (0.0,), lambda a: numpy.ceil(a), False),
+    'sqrt' : (('in',), (0.0,), lambda a: numpy.sqrt(a), False),
+    'sin' : (('in',), (0.0,), lambda a: numpy.sin(a), False),
+    'cos' : (('in',), (0.0,), lambda a: numpy.cos(a), False),
+    'invert' : (('in', 'amount'), (0.0, 1.0), lambda a, b: b - a, False),
+    'clamp' : (('in', 'low', 'high'), (0.0, 0.0, 1.0), lambda a, b, c: numpy.minimum(numpy.maximum(a, b), c), False),
+    'mix' : (('fg', 'bg', 'mix'), (0.0, 0.0, 0.0), lambda a, b, c: a * c + b * (1.0 - c), False),
+}
+
+# Geometric streams supplied per batch.
+kOpGraphStreams = ('texcoord', 'position')
+
+def parseOpGraphValue(value):
+    if isinstance(value, basestring):
+        value = [float(x) for x in value.split(',')]
+
+    return numpy.array(value, dtype = numpy.float64).reshape(-1)
+
+# An OpGraph compiled into a flat instruction list over numbered registers.
+# Constant sub-graphs are folded at compile time and identical operations on
+# identical registers are shared, evaluation then runs each remaining
+# instruction once over the whole batch of samples.
+class OpGraphProgram(object):
+
+    def __init__(self, opGraph):
+        if numpy is None:
+            raise ImportError('OpGraph evaluation requires numpy')
+
+        self.registers = []
+        self.instructions = []
+        self.streams = {}
+        self.outputs = collections.OrderedDict()
+
+        self.__constants = {}
+        self.__expressions = {}
+        self.__nodes = {}
+        self.__channels = {}
+        self.__opGraph = opGraph
+
+        # A node with a single channel broadcasts to any output type.
+        for (key, child) in opGraph.children.iteritems():
+            if isinstance(child, Output):
+                nodename = str(child.attributes['nodename'])
+                register = self.__compileNode(nodename, ())
+                channels = kTypeChannels.get(str(child.attributes[kTypeTag]), 1)
+                if not self.__channels[register] in (1, channels):
+                    raise ValueError('output %s of type %s cannot take the %d channels of node %s' %
+                        (key, child.attributes[kTypeTag], self.__channels[register], nodename))
+                self.outputs[key] = (register, channels)
+
+    def isConstant(self, register):
+        return self.registers[register] is not None
+
+    def __constant(self, value):
+        value = parseOpGraphValue(value)
+        key = tuple(value)
+        register = self.__constants.get(key)
+        if register is None:
+            register = self.__constants[key] = len(self.registers)
+            self.registers.append(value)
+            self.__channels[register] = len(value)
+
+        return register
+
+    def __temporary(self, channels):
+        self.registers.append(None)
+        self.__channels[len(self.registers) - 1] = channels
+
+        return len(self.registers) - 1
+
+    def __compileArgument(self, node, name, default, path):
+        child = node.children.get(name)
+        if isinstance(child, Input):
+            nodename = child.attributes['nodename'].value
+            if nodename:
+                return self.__compileNode(nodename, path)
+            if child.attributes[kValueTag].value is not None:
+                return self.__constant(child.attributes[kValueTag].value)
+        elif isinstance(child, Parameter) and child.attributes[kValueTag] is not None:
+            return self.__constant(child.attributes[kValueTag])
+
+        return self.__constant(default)
+
+    def __compileNode(self, name, path):
+        register = self.__nodes.get(name)
+        if register is not None:
+            return register
+
+        if name in path:
+            raise ValueError('cycle in opgraph at ' + name)
+        node = self.__opGraph.children[name]
+        category = node.getTypeName()
+        path = path + (name,)
+
+        if category == kConstantTag:
+            register = self.__compileArgument(node, kValueTag, 0.0, path)
+        elif category in kOpGraphStreams:
+            register = self.streams.get(category)
+            if register is None:
+                register = self.streams[category] = self.__temporary(kTypeChannels.get(str(node.attributes[kTypeTag]), 1))
+        else:
+            if not category in kOpGraphOperators:
+                raise ValueError('unsupported opgraph operator ' + category + ' at node ' + name)
+
+            (names, defaults, function, commutative) = kOpGraphOperators[category]
+            args = tuple(self.__compileArgument(node, n, d, path) for (n, d) in zip(names, defaults))
+            if commutative:
+                args = tuple(sorted(args))
+
+            # Folds constant arguments, otherwise gets the channels of the
+            # result from a run over a single sample.
+            try:
+                with numpy.errstate(all = 'ignore'):
+                    value = function(*[self.registers[arg] if self.isConstant(arg) else numpy.ones((1, self.__channels[arg]))
+                        for arg in args])
+            except ValueError:
+                raise ValueError('mismatched input channels %s for node %s' %
+                    (', '.join(str(self.__channels[arg]) for arg in args), name))
+
+            if all(self.isConstant(arg) for arg in args):
+                register = self.__constant(value)
+            else:
+                register = self.__expressions.get((category, args))
+                if register is None:
+                    register = self.__expressions[(category, args)] = self.__temporary(value.shape[-1])
+                    self.instructions.append((function, register, args))
+
+        self.__nodes[name] = register
+
+        return register
+
+    def evaluate(self, texcoord = None, position = None, count = None):
+        registers = list(self.registers)
+
+        for (stream, value) in (('texcoord', texcoord), ('position', position)):
+            if value is None:
+                continue
+            value = numpy.asarray(value, dtype = numpy.float64)
+            count = value.shape[0]
+            if stream in self.streams:
+                registers[self.streams[stream]] = value
+
+        for stream in self.streams:
+            if registers[self.streams[stream]] is None:
+                raise ValueError('missing ' + stream + ' samples')
+
+        for (function, register, args) in self.instructions:
+            registers[register] = function(*[registers[arg] for arg in args])
+
+        result = collections.OrderedDict()
+        for (key, (register, channels)) in self.outputs.iteritems():
+            value = registers[register]
+            result[key] = numpy.array(numpy.broadcast_to(value, (count or 1, channels)))
+
+        return result
+
+#
+#
+kParameterTableMagic = 'MXSCOL01'
+kParameterTableAlignment = 64
+
+# Shader and Parameter data of one or many MaterialX documents, flattened into
+# typed columns so library-wide queries become vectorized scans. Names, types
+# and programs are ids into 'strings', numeric values are decoded into the
+# flat 'values' array and addressed by each parameter's offset and count,
+# other values keep a string id in the 'string' column.
+class ParameterTable(object):
+
+    kShaderDType = [('document', '<i4'), ('name', '<i4'), ('shadertype', '<i4'), ('shaderprogram', '<i4')]
+    kParameterDType = [('shader', '<i4'), ('name', '<i4'), ('type', '<i4'), ('offset', '<i4'), ('count', '<i4'), ('string', '<i4')]
+
+    def __init__(self, strings, shaders, parameters, values):
+        self.strings = strings
+        self.shaders = shaders
+        self.parameters = parameters
+        self.values = values
+        self.__stringIds = dict((s, i) for (i, s) in enumerate(strings))
+
+    @staticmethod
+    def fromMaterialX(mtlxs):
+        if numpy is None:
+            raise ImportError('ParameterTable requires numpy')
+        if isinstance(mtlxs, MaterialX):
+            mtlxs = [mtlxs]
+
+        strings = []
+        stringIds = {}
+        shaders = []
+        parameters = []
+        values = array.array('d')
+
+        def stringId(s):
+            if s is None:
+                return -1
+            s = unicode(s)
+            index = stringIds.get(s)
+            if index is None:
+                index = stringIds[s] = len(strings)
+                strings.append(s)
+            return index
+
+        def decode(value):
+            if isinstance(value, Attribute):
+                value = value.value
+            if isinstance(value, basestring):
+                try:
+                    return [float(x) for x in value.split(',')]
+                except ValueError:
+                    return None
+            if isinstance(value, (list, tuple)):
+                return [float(x) for x in value]
+            if value is None:
+                return None
+            return [float(value)]
+
+        def collect(document, element):
+            for child in element.children.itervalues():
+                if isinstance(child, Shader):
+                    shader = len(shaders)
+                    shaders.append((document, stringId(child.attributes[kNameTag].value),
+                        stringId(child.attributes['shadertype'].value), stringId(child.attributes['shaderprogram'].value)))
+
+                    for parameter in child.children.itervalues():
+                        if not isinstance(parameter, Parameter):
+                            continue
+
+                        value = parameter.attributes[kValueTag]
+                        ptype = parameter.attributes[kTypeTag].value
+                        decoded = decode(value) if ptype in kTypeChannels else None
+                        if decoded is None:
+                            parameters.append((shader, stringId(parameter.attributes[kNameTag].value), stringId(ptype),
+                                len(values), 0, stringId(value)))
+                        else:
+                            parameters.append((shader, stringId(parameter.attributes[kNameTag].value), stringId(ptype),
+                                len(values), len(decoded), -1))
+                            values.extend(decoded)
+                else:
+                    collect(document, child)
+
+        for (document, mtlx) in enumerate(mtlxs):
+            collect(document, mtlx)
+
+        return ParameterTable(strings,
+            numpy.array(shaders, dtype = ParameterTable.kShaderDType),
+            numpy.array(parameters, dtype = ParameterTable.kParameterDType),
+            numpy.frombuffer(values, dtype = numpy.float64).copy())
+
+    def stringId(self, s):
+        return self.__stringIds.get(unicode(s), -1)
+
+    def parameterValues(self, name, channels = 1):
+        rows = numpy.flatnonzero((self.parameters['name'] == self.stringId(name)) & (self.parameters['count'] >= channels))
+        offsets = self.parameters['offset'][rows]
+
+        return (rows, self.values[offsets[:, numpy.newaxis] + numpy.arange(channels)])
+
+    def shaderNames(self, shaders):
+        return [self.strings[i] for i in self.shaders['name'][shaders]]
+
+    # File layout: magic, every column aligned to kParameterTableAlignment so
+    # it can be memory mapped, then a JSON footer and its length.
+    def save(self, path):
+        footer = {'strings' : self.strings, 'columns' : []}
+
+        with open(path, 'wb') as f:
+            f.write(kParameterTableMagic)
+            for (name, column) in (('shaders', self.shaders), ('parameters', self.parameters), ('values', self.values)):
+                f.write('\0' * (-f.tell() % kParameterTableAlignment))
+                footer['columns'].append((name, len(column), f.tell()))
+                f.write(column.tobytes())
+
+            footerData = json.dumps(footer)
+            f.write(footerData)
+            f.write(struct.pack('<Q', len(footerData)))
+
+    @staticmethod
+    def load(path, mmap = True):
+        if numpy is None:
+            raise ImportError('ParameterTable requires numpy')
+
+        with open(path, 'rb') as f:
+            assert(f.read(len(kParameterTableMagic)) == kParameterTableMagic)
+            f.seek(-8, os.SEEK_END)
+            (footerLength,) = struct.unpack('<Q', f.read(8))
+            f.seek(-8 - footerLength, os.SEEK_END)
+            footer = json.loads(f.read(footerLength))
+
+            dtypes = {'shaders' : ParameterTable.kShaderDType, 'parameters' : ParameterTable.kParameterDType, 'values' : '<f8'}
+            columns = {}
+            for (name, length, offset) in footer['columns']:
+                if mmap and length > 0:
+                    columns[name] = numpy.memmap(path, dtypes[name], 'r', offset, (length,))
+                else:
+                    f.seek(offset)
+                    columns[name] = numpy.fromfile(f, dtypes[name], length)
+
+        return ParameterTable(footer['strings'], columns['shaders'], columns['parameters'], columns['values'])
+
+#
+#
+kComposeMerge = 'merge'
+kComposeReplace = 'replace'
+
+# How an element of a stronger layer overrides the same named element of a
+# weaker one: containers merge attributes and children, anything else is
+# replaced as a whole.
+kComposePolicies = {
+    MaterialX : kComposeMerge,
+    Shader : kComposeMerge,
+    Material : kComposeMerge,
+    Look : kComposeMerge,
+    AOVSet : kComposeMerge,
+    Collection : kComposeMerge,
+    GeomInfo : kComposeMerge,
+    OpGraph : kComposeMerge,
+    Constant : kComposeMerge,
+    OpNode : kComposeMerge,
+}
+
+def isAuthoredAttribute(attr):
+    if isinstance(attr, Attribute):
+        attr = attr.value
+
+    return not (attr is None or attr == '')
+
+def copyAttribute(attr):
+    if not isinstance(attr, Attribute):
+        return attr
+
+    value = attr.value
+    if isinstance(value, list):
+        value = list(value)
+
+    return attr.__class__(attr.name, attr.required, value)
+
+def elementsEqual(a, b):
+    if a is b:
+        return True
+    if a.__class__ is not b.__class__ or a.getTypeName() != b.getTypeName():
+        return False
+    if a.attributes.keys() != b.attributes.keys() or a.children.keys() != b.children.keys():
+        return False
+
+    # Raw values, e.g. parameter values, may be unicode and are compared as is.
+    for (key, attr) in a.attributes.iteritems():
+        other = b.attributes[key]
+        if isinstance(attr, Attribute) or isinstance(other, Attribute):
+            if (attr is None) != (other is None) or str(attr) != str(other):
+                return False
+        elif attr != other:
+            return False
+
+    for (key, child) in a.children.iteritems():
+        if not elementsEqual(child, b.children[key]):
+            return False
+
+    return True
+
+# Result of composeMaterialX(). Paths are tuples of child keys from the root.
+# Subtrees taken unchanged from a single layer are shared by reference and
+# only their root is recorded, layerOf() resolves any path inside them.
+class Composition(object):
+
+    def __init__(self):
+        self.mtlx = None
+        self.provenance = {}
+        self.attributeProvenance = {}
+
+    def layerOf(self, path):
+        path = tuple(path)
+        while not path in self.provenance:
+            path = path[:-1]
+
+        return self.provenance[path]
+
+    def attributeLayerOf(self, path, key):
+        path = tuple(path)
+        layer = self.attributeProvenance.get((path, key))
+        if layer is None:
+            layer = self.layerOf(path)
+
+        return layer
+
+# Layers N documents, weakest first. Each layer is folded into the result
+# through the children name index, so the cost is linear in the number of
+# elements of the layers. Merged elements are new elements with their own
+# copies of the attributes, but the composed tree aliases the layers below
+# them: children taken unchanged from a layer are the layer's elements, and
+# changing them changes that layer too.
+def composeMaterialX(layers, policies = kComposePolicies):
+    composition = Composition()
+    owned = set()
+    # Provenance keys recorded at or below each path, so that replacing an
+    # element forgets everything recorded for the subtree it replaces.
+    recorded = collections.defaultdict(list)
+
+    def record(table, key, path, layer):
+        table[key] = layer
+        for i in xrange(len(path) + 1):
+            recorded[path[:i]].append((table, key))
+
+    def forget(path):
+        for (table, key) in recorded.pop(path, ()):
+            table.pop(key, None)
+
+    def own(element):
+        if id(element) in owned:
+            return element
+
+        elementType = element.__class__
+        copy = elementType.__new__(elementType)
+        copy.__dict__.update((k, v) for (k, v) in element.__dict__.iteritems() if not k in kFlatElementState)
+        Element.__init__(copy)
+        copy.attributes.update((key, copyAttribute(attr)) for (key, attr) in element.attributes.iteritems())
+        copy.children.update(element.children)
+        owned.add(id(copy))
+
+        return copy
+
+    def compose(existing, incoming, layer, path):
+        if existing is None:
+            record(composition.provenance, path, path, layer)
+            return incoming
+
+        policy = policies.get(existing.__class__, kComposeReplace)
+        if policy == kComposeReplace or existing.__class__ is not incoming.__class__ or \
+                existing.getTypeName() != incoming.getTypeName():
+            if elementsEqual(existing, incoming):
+                return existing
+            forget(path)
+            record(composition.provenance, path, path, layer)
+            return incoming
+
+        attributes = []
+        for (key, attr) in incoming.attributes.iteritems():
+            if isAuthoredAttribute(attr) and not (key in existing.attributes and str(existing.attributes[key]) == str(attr)):
+                attributes.append((key, copyAttribute(attr)))
+                record(composition.attributeProvenance, (path, key), path, layer)
+
+        children = []
+        for (key, child) in incoming.children.iteritems():
+            current = existing.children.get(key)
+            result = compose(current, child, layer, path + (key,))
+            if result is not current:
+                children.append((key, result))
+
+        if not attributes and not children:
+            return existing
+
+        merged = own(existing)
+        merged.attributes.update(attributes)
+        merged.children.update(children)
+
+        return merged
+
+    root = MaterialX()
+    owned.add(id(root))
+    record(composition.provenance, (), (), 0)
+    for (layer, mtlx) in enumerate(layers):
+        root = compose(root, mtlx, layer, ())
+
+    composition.mtlx = root
+
+    return composition
+
+# Observes every element and attribute of a tree, following children and
+# attributes as they are added or removed. Subclasses implement treeChanged()
+# and may track where objects live through attached()/detached()/pathOf(),
+# paths being tuples of child keys from the root.
+class TreeObserver(object):
+
+    # owner is the parent of an element (None for the root) or the element
+    # holding an attribute.
+    def attach(self, element, path = (), owner = None):
+        element.addObserver(self)
+        self.attached(element, path, None, owner)
+        for (key, attr) in element.attributes.iteritems():
+            if isinstance(attr, Attribute):
+                attr.addObserver(self)
+                self.attached(attr, path, key, element)
+        for (key, child) in element.children.iteritems():
+            self.attach(child, path + (key,), element)
+
+    def detach(self, element):
+        element.removeObserver(self)
+        self.detached(element)
+        for attr in element.attributes.itervalues():
+            if isinstance(attr, Attribute):
+                attr.removeObserver(self)
+                self.detached(attr)
+        for child in element.children.itervalues():
+            self.detach(child)
+
+    def attached(self, obj, path, key, owner):
+        pass
+
+    def detached(self, obj):
+        pass
+
+    def pathOf(self, element):
+        return ()
+
+    def objectChanged(self, obj, kind, key, old, new):
+        if kind == kChildChanged:
+            if old is not None:
+                self.detach(old)
+            if new is not None:
+                self.attach(new, self.pathOf(obj) + (key,), obj)
+        elif kind == kAttributeChanged:
+            if isinstance(old, Attribute):
+                old.removeObserver(self)
+                self.detached(old)
+            if isinstance(new, Attribute):
+                new.addObserver(self)
+                self.attached(new, self.pathOf(obj), key, obj)
+
+        self.treeChanged(obj, kind, key, old, new)
+
+    def treeChanged(self, obj, kind, key, old, new):
+        pass
+
+#
+#
+kSelectorChild = '>'
+kSelectorDescendant = ' '
+
+kSelectorStepRegex = re.compile(r'\s*(>)?\s*([\w:*]+)((?:\[[^\]]*\])*)')
+kSelectorPredicateRegex = re.compile(r'\[\s*([\w:]+)\s*(!=|>=|<=|=|<|>)\s*(?:"([^"]*)"|\'([^\']*)\'|([^\]]*?))\s*\]')
+
+kSelectorOperators = {
+    '=' : lambda a, b: a == b,
+    '!=' : lambda a, b: a != b,
+    '<' : lambda a, b: a < b,
+    '>' : lambda a, b: a > b,
+    '<=' : lambda a, b: a <= b,
+    '>=' : lambda a, b: a >= b,
+}
+
+# A selector is a list of steps separated by whitespace (descendant) or '>'
+# (child), each step a type name or '*' followed by attribute predicates:
+#   shader[shaderprogram=lambert]
+#   shader[shadertype=surface] parameter[type=color3]
+#   look > materialassign[collection="xyzCol"]
+#   parameter[name=spec*][value>=0.5]
+# '=' and '!=' compare strings, with glob patterns for '=', the others
+# compare numbers.
+def parseSelector(selector):
+    steps = []
+    position = 0
+    selector = selector.strip()
+    while position < len(selector):
+        match = kSelectorStepRegex.match(selector, position)
+        if match is None or match.end() == position:
+            raise ValueError('invalid selector: ' + selector)
+
+        predicates = []
+        predicatePosition = 0
+        for predicate in kSelectorPredicateRegex.finditer(match.group(3)):
+            if predicate.start() != predicatePosition:
+                break
+            predicatePosition = predicate.end()
+            (key, op, v1, v2, v3) = predicate.groups()
+            value = v1 or v2 or v3
+            glob = op == '=' and any(c in value for c in '*?[')
+            predicates.append((key, op, value, glob))
+        if predicatePosition != len(match.group(3)):
+            raise ValueError('invalid predicate in selector: ' + selector)
+
+        axis = kSelectorChild if match.group(1) else kSelectorDescendant
+        steps.append((axis, match.group(2), predicates))
+        position = match.end()
+
+    return steps
+
+# Answers selector queries over the tree under root, returning elements in
+# document order. The type index is kept up to date from the start, an index
+# on the values of an attribute is built on first use. Changes update the
+# indexes in place: an added or removed subtree only adds or removes its own
+# elements, an attribute change only moves its element within the index of
+# that attribute.
+class ElementQuery(TreeObserver):
+
+    def __init__(self, root):
+        self.root = root
+        self.__selectors = {}
+        self.__elements = collections.OrderedDict()
+        self.__parents = {}
+        self.__keys = {}
+        self.__owners = {}
+        self.__types = collections.defaultdict(collections.OrderedDict)
+        self.__attributeIndexes = {}
+        self.__orders = {}
+        self.attach(root)
+
+    def close(self):
+        self.detach(self.root)
+
+    def attached(self, obj, path, key, owner):
+        if isinstance(obj, Attribute):
+            self.__owners[id(obj)] = (owner, key)
+            return
+
+        self.__elements[id(obj)] = obj
+        self.__types[obj.getTypeName()][id(obj)] = obj
+        if owner is not None:
+            self.__parents[id(obj)] = owner
+            self.__keys[id(obj)] = path[-1]
+        for attrKey in self.__attributeIndexes:
+            self.__index(obj, attrKey)
+
+    def detached(self, obj):
+        if isinstance(obj, Attribute):
+            self.__owners.pop(id(obj), None)
+            return
+
+        del self.__elements[id(obj)]
+        typeName = obj.getTypeName()
+        del self.__types[typeName][id(obj)]
+        if not self.__types[typeName]:
+            del self.__types[typeName]
+        self.__parents.pop(id(obj), None)
+        self.__keys.pop(id(obj), None)
+        self.__orders.pop(id(obj), None)
+        for attrKey in self.__attributeIndexes:
+            self.__unindex(obj, attrKey)
+
+    def treeChanged(self, obj, kind, key, old, new):
+        if kind == kChildChanged:
+            order = self.__orders.get(id(obj))
+            if order is not None and old is None:
+                order[0][key] = order[1]
+                order[1] += 1
+        elif kind == kOrderChanged:
+            self.__orders.pop(id(obj), None)
+        elif kind == kValueChanged:
+            (element, attrKey) = self.__owners[id(obj)]
+            self.__reindex(element, attrKey)
+        else:
+            self.__reindex(obj, key)
+
+    def __index(self, element, key):
+        (index, indexed) = self.__attributeIndexes[key]
+        attr = element.attributes.get(key)
+        if isAuthoredAttribute(attr):
+            value = indexed[id(element)] = str(attr)
+            index[value][id(element)] = element
+
+    def __unindex(self, element, key):
+        (index, indexed) = self.__attributeIndexes[key]
+        value = indexed.pop(id(element), None)
+        if value is not None:
+            del index[value][id(element)]
+            if not index[value]:
+                del index[value]
+
+    def __reindex(self, element, key):
+        if key in self.__attributeIndexes:
+            self.__unindex(element, key)
+            self.__index(element, key)
+
+    # Maps each value of the attribute to the elements having it, by id.
+    def attributeIndex(self, key):
+        if not key in self.__attributeIndexes:
+            self.__attributeIndexes[key] = (collections.defaultdict(collections.OrderedDict), {})
+            for element in self.__elements.itervalues():
+                self.__index(element, key)
+
+        return self.__attributeIndexes[key][0]
+
+    # Maps each type name to the elements of that type, by id.
+    def typeIndex(self):
+        return self.__types
+
+    # Positions of the children of an element, kept until its children are
+    # reordered. New children go last, removed ones leave a gap.
+    def __order(self, element):
+        order = self.__orders.get(id(element))
+        if order is None:
+            keys = element.children.keys()
+            order = self.__orders[id(element)] = [dict((key, i) for (i, key) in enumerate(keys)), len(keys)]
+
+        return order[0]
+
+    def __position(self, element):
+        position = []
+        while element is not self.root:
+            parent = self.__parents[id(element)]
+            position.append(self.__order(parent)[self.__keys[id(element)]])
+            element = parent
+        position.reverse()
+
+        return position
+
+    def __matchStep(self, element, step):
+        (axis, typeName, predicates) = step
+        if typeName != '*' and element.getTypeName() != typeName:
+            return False
+
+        for (key, op, value, glob) in predicates:
+            attr = element.attributes.get(key)
+            if not isAuthoredAttribute(attr):
+                return False
+            if glob:
+                if not fnmatch.fnmatchcase(str(attr), value):
+                    return False
+            elif op == '=' or op == '!=':
+                if not kSelectorOperators[op](str(attr), value):
+                    return False
+            else:
+                try:
+                    if not kSelectorOperators[op](float(str(attr)), float(value)):
+                        return False
+                except ValueError:
+                    return False
+
+        return True
+
+    def __matchAncestors(self, element, steps, index, parents):
+        axis = steps[index][0]
+        parent = parents.get(id(element))
+        if index == 0:
+            return axis == kSelectorDescendant or parent is self.root
+
+        while parent is not None:
+            if self.__matchStep(parent, steps[index - 1]) and self.__matchAncestors(parent, steps, index - 1, parents):
+                return True
+            if axis == kSelectorChild:
+                return False
+            parent = parents.get(id(parent))
+
+        return False
+
+    # Picks the smallest candidate set for the last step among the type
+    # index and the indexes of its exact '=' predicates.
+    def __candidates(self, step):
+        (axis, typeName, predicates) = step
+
+        candidates = self.__elements
+        if typeName != '*':
+            candidates = self.__types.get(typeName, {})
+        for (key, op, value, glob) in predicates:
+            if op == '=' and not glob:
+                indexed = self.attributeIndex(key).get(value, {})
+                if len(indexed) < len(candidates):
+                    candidates = indexed
+
+        return candidates.itervalues()
+
+    def select(self, selector):
+        steps = self.__selectors.get(selector)
+        if steps is None:
+            steps = self.__selectors[selector] = parseSelector(selector)
+
+        last = len(steps) - 1
+        result = [element for element in self.__candidates(steps[last])
+            if self.__matchStep(element, steps[last]) and self.__matchAncestors(element, steps, last, self.__parents)]
+        if len(result) > 1:
+            result.sort(key = self.__position)
+
+        return result
+
+    def first(self, selector):
+        result = self.select(selector)
+
+        return result[0] if result else None
+
+#
+#
+kContainerMagic = 'MXSZ0001'
+kContainerChunkSize = 1 << 16
+
+# Codec name : (compress, decompress). Only stdlib codecs are used.
+kContainerCodecs = {
+    'zlib' : (lambda data: zlib.compress(data, 6), zlib.decompress),
+    'bz2' : (lambda data: bz2.compress(data, 9), bz2.decompress),
+}
+
+# Compressed .mtlx container. Top-level elements are serialized in order
+# and grouped into chunks of about chunkSize bytes, each compressed on its
+# own. A JSON footer maps the children keys to their chunk and their position
+# in it, so a single element is read by decompressing only its chunk. Layout:
+#   magic, chunk 0 .. chunk N-1, footer, footer length, magic
+def writeMaterialXContainer(mtlx, path, codec = 'zlib', chunkSize = kContainerChunkSize):
+    compress = kContainerCodecs[codec][0]
+    xmlDoc = xml.dom.minidom.Document()
+    chunks = []
+    elements = []
+    pending = []
+
+    with open(path, 'wb') as f:
+        f.write(kContainerMagic)
+
+        def flush():
+            data = compress(''.join(pending))
+            chunks.append((f.tell(), len(data)))
+            f.write(data)
+            del pending[:]
+
+        pendingSize = 0
+        for (key, child) in mtlx.children.iteritems():
+            data = child.toXmlNode(xmlDoc).toxml('utf-8')
+            elements.append((key, len(chunks), len(pending)))
+            pending.append(data)
+            pendingSize += len(data)
+            if pendingSize >= chunkSize:
+                flush()
+                pendingSize = 0
+
+        if pending:
+            flush()
+
+        attributes = [(key, str(attr)) for (key, attr) in mtlx.attributes.iteritems() if isAuthoredAttribute(attr)]
+        footer = json.dumps({'codec' : codec, 'attributes' : attributes, 'chunks' : chunks, 'elements' : elements})
+        f.write(footer)
+        f.write(struct.pack('<Q', len(footer)))
+        f.write(kContainerMagic)
+
+class MaterialXContainer(object):
+
+    def __init__(self, f):
+        self.__owned = isinstance(f, basestring)
+        if self.__owned:
+            f = open(f, 'rb')
+        self.file = f
+
+        trailerLength = 8 + len(kContainerMagic)
+        f.seek(-trailerLength, os.SEEK_END)
+        trailer = f.read(trailerLength)
+        assert(trailer[8:] == kContainerMagic)
+        (footerLength,) = struct.unpack('<Q', trailer[:8])
+        f.seek(-trailerLength - footerLength, os.SEEK_END)
+        footer = json.loads(f.read(footerLength))
+
+        self.codec = footer['codec']
+        self.chunks = footer['chunks']
+        self.elements = collections.OrderedDict((element[0], element[1]) for element in footer['elements'])
+        self.__positions = dict((element[0], element[2]) for element in footer['elements'] if len(element) > 2)
+        self.__decompress = kContainerCodecs[self.codec][1]
+        self.__openTag = '<%s %s>' % (kMaterialXTag,
+            ' '.join('%s=%s' % (key, xml.sax.saxutils.quoteattr(value)) for (key, value) in footer['attributes']))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, excType, excValue, traceback):
+        self.close()
+
+    def close(self):
+        if self.__owned:
+            self.file.close()
+
+    def names(self):
+        return self.elements.keys()
+
+    def readChunk(self, index):
+        (offset, length) = self.chunks[index]
+        self.file.seek(offset)
+        data = self.__decompress(self.file.read(length))
+
+        return xml.dom.minidom.parseString(self.__openTag + data + '</%s>' % kMaterialXTag).documentElement
+
+    def readInto(self, mtlx):
+        for index in xrange(len(self.chunks)):
+            mtlx.fromXmlNode(self.readChunk(index))
+
+    def read(self):
+        mtlx = MaterialX()
+        self.readInto(mtlx)
+
+        return mtlx
+
+    # Reads the element stored under the children key name, which need not
+    # be its name attribute.
+    def readElement(self, name):
+        xmlNode = self.readChunk(self.elements[name])
+        position = self.__positions.get(name)
+        if position is None:
+            mtlx = MaterialX()
+            mtlx.fromXmlNode(xmlNode)
+
+            return mtlx.children[name]
+
+        childXmlNodes = [child for child in xmlNode.childNodes if child.nodeType == child.ELEMENT_NODE]
+        for (i, child) in enumerate(childXmlNodes):
+            if i != position:
+                xmlNode.removeChild(child)
+        mtlx = MaterialX()
+        mtlx.fromXmlNode(xmlNode)
+
+        return mtlx.children.values()[0]
+
+#
+#
+kElementAdded = 'added'
+kElementRemoved = 'removed'
+kAttributeSet = 'set'
+kElementReordered = 'reordered'
+
+# kind is kElementAdded (value is the element, replacing any previous one at
+# path), kElementRemoved, kAttributeSet (key and value of the attribute,
+# None when it was removed) or kElementReordered (value is the new order of
+# the keys of the children of the element at path).
+ChangeEvent = collections.namedtuple('ChangeEvent', ('kind', 'path', 'key', 'value'))
+
+# Turns changes of the tree under root into ChangeEvents and delivers them
+# to subscribers in coalesced batches: only the last value of an attribute
+# is kept, an element added then removed cancels out and changes inside an
+# added or removed element are folded into that element's event.
+#
+# A batch is delivered when the outermost transaction() ends, on flush(),
+# or after window seconds from its first event (on a timer thread).
+# window = 0 delivers every change at once, window = None waits for an
+# explicit flush(), e.g. once per frame.
+class ChangeStream(TreeObserver):
+
+    def __init__(self, root, window = None):
+        self.root = root
+        self.window = window
+        self.__subscribers = []
+        self.__paths = {}
+        self.__lock = threading.RLock()
+        self.__pending = collections.OrderedDict()
+        self.__existed = {}
+        self.__depth = 0
+        self.__timer = None
+        self.attach(root)
+
+    def close(self):
+        with self.__lock:
+            if self.__timer is not None:
+                self.__timer.cancel()
+                self.__timer = None
+        self.detach(self.root)
+
+    def subscribe(self, callback):
+        self.__subscribers.append(callback)
+
+        return callback
+
+    def unsubscribe(self, callback):
+        self.__subscribers.remove(callback)
+
+    def attached(self, obj, path, key, owner):
+        self.__paths[id(obj)] = (path, key)
+
+    def detached(self, obj):
+        self.__paths.pop(id(obj), None)
+
+    def pathOf(self, element):
+        return self.__paths[id(element)][0]
+
+    @contextlib.contextmanager
+    def transaction(self):
+        with self.__lock:
+            self.__depth += 1
+        try:
+            yield self
+        finally:
+            with self.__lock:
+                self.__depth -= 1
+                depth = self.__depth
+            if depth == 0:
+                self.flush()
+
+    def treeChanged(self, obj, kind, key, old, new):
+        if kind == kChildChanged:
+            path = self.pathOf(obj) + (key,)
+            if new is None:
+                self.__record(kElementRemoved, path, None, None, old)
+            else:
+                self.__record(kElementAdded, path, None, new, old)
+        elif kind == kOrderChanged:
+            self.__record(kElementReordered, self.pathOf(obj), None, new, None)
+        else:
+            if kind == kValueChanged:
+                (path, key) = self.__paths[id(obj)]
+            else:
+                path = self.pathOf(obj)
+                if isinstance(new, Attribute):
+                    new = new.value
+            self.__record(kAttributeSet, path, key, new, None)
+
+    def __record(self, kind, path, key, value, old):
+        with self.__lock:
+            if kind == kAttributeSet or kind == kElementReordered:
+                entry = (kind, path, key)
+                self.__pending.pop(entry, None)
+                self.__pending[entry] = ChangeEvent(kind, path, key, value)
+            else:
+                entry = (kElementAdded, path)
+                if not entry in self.__existed:
+                    self.__existed[entry] = old is not None
+                self.__pending.pop(entry, None)
+                if kind == kElementAdded or self.__existed[entry]:
+                    self.__pending[entry] = ChangeEvent(kind, path, key, value)
+
+            if self.__depth > 0 or self.window is None:
+                return
+            if self.window > 0:
+                if self.__timer is None:
+                    self.__timer = threading.Timer(self.window, self.flush)
+                    self.__timer.daemon = True
+                    self.__timer.start()
+                return
+
+        self.flush()
+
+    def flush(self):
+        with self.__lock:
+            if self.__timer is not None:
+                self.__timer.cancel()
+                self.__timer = None
+            pending = self.__pending.values()
+            self.__pending.clear()
+            # Includes elements added then removed, whose events cancelled out.
+            elementPaths = set(path for (kind, path) in self.__existed)
+            self.__existed.clear()
+
+        def folded(event):
+            depth = len(event.path) if event.kind in (kAttributeSet, kElementReordered) else len(event.path) - 1
+            for i in xrange(1, depth + 1):
+                if event.path[:i] in elementPaths:
+                    return True
+            return False
+
+        events = [event for event in pending if not folded(event)]
+        if events:
+            for callback in list(self.__subscribers):
+                callback(events)
+
+        return events
+
+#
+# Splits .mtlx data into its top-level elements without building a DOM.
+# Returns the bytes before the first element (the XML declaration and the
+# root start tag, in the encoding of the file) and an ordered list of
+# (name, bytes), each element running up to the next one or to the root end
+# tag. Names are encoded as UTF-8.
+def splitMaterialXElements(data):
+    parser = xml.parsers.expat.ParserCreate()
+    state = {'depth' : 0, 'end' : len(data)}
+    starts = []
+
+    def startElement(name, attrs):
+        if state['depth'] == 1:
+            starts.append((attrs.get(kNameTag, u'').encode('utf-8'), parser.CurrentByteIndex))
+        state['depth'] += 1
+
+    def endElement(name):
+        state['depth'] -= 1
+        if state['depth'] == 0:
+            state['end'] = parser.CurrentByteIndex
+
+    parser.StartElementHandler = startElement
+    parser.EndElementHandler = endElement
+    parser.Parse(data, True)
+
+    ends = [start for (name, start) in starts[1:]] + [state['end']]
+    elements = [(name, data[start:end]) for ((name, start), end) in zip(starts, ends)]
+    head = data[:starts[0][1] if starts else state['end']]
+
+    return (head, elements)
+
+# Keeps a MaterialX in sync with a .mtlx file. Each reload fingerprints the
+# top-level elements of the file and only parses those whose bytes changed,
+# patching them into the live tree: unchanged elements keep their identity.
+# Compressed containers are parsed whole and patched the same way, keeping
+# elements equal to the current ones.
+class MaterialXWatcher(object):
+
+    def __init__(self, path, mtlx = None, interval = 1.0, callback = None):
+        self.path = path
+        self.mtlx = mtlx if mtlx is not None else MaterialX()
+        self.interval = interval
+        self.callback = callback
+        self.__fingerprints = {}
+        self.__stat = None
+        self.__stop = threading.Event()
+        self.__thread = None
+
+        self.reload()
+
+    def reload(self):
+        stat = os.stat(self.path)
+        with open(self.path, 'rb') as f:
+            data = f.read()
+
+        if data.startswith(kContainerMagic):
+            parsed = parseMaterialX(data).children
+            order = parsed.keys()
+            fingerprints = {}
+        else:
+            (head, elements) = splitMaterialXElements(data)
+            order = [name for (name, chunk) in elements]
+            fingerprints = dict((name, hashlib.md5(chunk).digest()) for (name, chunk) in elements)
+
+            changed = [chunk for (name, chunk) in elements if self.__fingerprints.get(name) != fingerprints[name]]
+            parsed = {}
+            if changed:
+                parsed = parseMaterialX(head + ''.join(changed) + '</%s>' % kMaterialXTag).children
+
+        children = self.mtlx.children
+        changed = []
+        for (name, element) in parsed.iteritems():
+            current = children.get(name)
+            if current is None or not elementsEqual(current, element):
+                children[name] = element
+                changed.append(name)
+
+        present = set(order)
+        removed = [name for name in children.keys() if not name in present]
+        for name in removed:
+            del children[name]
+
+        if children.keys() != order:
+            children.reorder([name for name in order if name in children])
+
+        self.__fingerprints = fingerprints
+        self.__stat = (stat.st_mtime, stat.st_size)
+        if self.callback is not None and (changed or removed):
+            self.callback(changed, removed)
+
+        return (changed, removed)
+
+    def poll(self):
+        stat = os.stat(self.path)
+        if (stat.st_mtime, stat.st_size) == self.__stat:
+            return None
+
+        return self.reload()
+
+    def start(self):
+        self.__stop.clear()
+        self.__thread = threading.Thread(target = self.__run)
+        self.__thread.daemon = True
+        self.__thread.start()
+
+    def stop(self):
+        self.__stop.set()
+        if self.__thread is not None:
+            self.__thread.join()
+            self.__thread = None
+
+    def __run(self):
+        while not self.__stop.wait(self.interval):
+            try:
+                self.poll()
+            except (IOError, OSError, xml.parsers.expat.ExpatError):
+                pass
+
+#
+#
+kMemoryRootOwner = -2
+kMemorySharedOwner = -1
+
+# Deep retained sizes of a MaterialX tree, from memoryReport(). Every object
+# is counted once: it is charged to the first top-level element reaching it,
+# and bytes also reached from other top-level elements are summed in
+# 'shared'. Process-wide singletons (None, booleans, small integers, empty
+# and single character strings) are free. With sampling, sizes are
+# extrapolated from the sampled children and only sampled top-level elements
+# are listed.
+class MemoryReport(object):
+
+    def __init__(self):
+        self.total = 0
+        self.shared = 0
+        self.sampled = False
+        self.elements = []
+        self.types = collections.defaultdict(float)
+        self.attributeTypes = collections.defaultdict(float)
+        self.parameterTypes = collections.defaultdict(float)
+
+    def top(self, count = 10, typeName = None):
+        elements = [e for e in self.elements if typeName is None or e[1] == typeName]
+
+        return sorted(elements, key = lambda e: -e[2])[:count]
+
+    def __str__(self):
+        lines = ['total %d bytes, shared %d bytes%s' % (self.total, self.shared, ' (sampled)' if self.sampled else '')]
+        for (title, table) in (('element types', self.types), ('attribute types', self.attributeTypes),
+                ('parameter types', self.parameterTypes)):
+            lines.append(title + ':')
+            for (key, size) in sorted(table.iteritems(), key = lambda item: -item[1]):
+                lines.append('  %-24s %12d' % (key, size))
+        lines.append('top elements:')
+        for (key, typeName, size) in self.top():
+            lines.append('  %-24s %-16s %12d' % (key, typeName, size))
+
+        return '\n'.join(lines)
+
+# With sample > 0 at most that many children of any element are walked,
+# chosen at random, and their sizes are scaled up to the full child count.
+def memoryReport(mtlx, sample = None, seed = 0):
+    report = MemoryReport()
+    owners = {}
+    rand = random.Random(seed)
+
+    # Returns the size charged to owner and whether the object's contents
+    # still need a visit: on first sight, or when it turns out to be shared.
+    def charge(obj, owner):
+        if obj is None or obj is True or obj is False or \
+                (type(obj) is int and -5 <= obj <= 256) or (type(obj) is str and len(obj) < 2):
+            return (0, False)
+
+        current = owners.get(id(obj))
+        if current is None:
+            size = sys.getsizeof(obj)
+            owners[id(obj)] = [owner, size]
+            return (size, True)
+
+        if current[0] != owner and current[0] != kMemorySharedOwner:
+            report.shared += current[1]
+            current[0] = kMemorySharedOwner
+            return (0, True)
+
+        return (0, False)
+
+    def deep(obj, owner):
+        (size, visit) = charge(obj, owner)
+        if visit and isinstance(obj, (list, tuple)):
+            for item in obj:
+                size += deep(item, owner)
+        elif visit and isinstance(obj, dict):
+            for (key, value) in obj.iteritems():
+                size += deep(key, owner) + deep(value, owner)
+
+        return size
+
+    def state(obj, owner, skip):
+        (size, visit) = charge(obj, owner)
+        if visit:
+            size += charge(obj.__dict__, owner)[0]
+            for (key, value) in obj.__dict__.iteritems():
+                size += deep(key, owner)
+                if not key in skip:
+                    size += deep(value, owner)
+
+        return size
+
+    # An OrderedDict's links are charged one by one, following them as
+    # plain lists would recurse through the whole dict.
+    def elementDict(d, owner):
+        (size, visit) = charge(d, owner)
+        if visit:
+            size += charge(d.__dict__, owner)[0]
+            links = d.__dict__.get('_OrderedDict__map')
+            if links is not None:
+                size += charge(links, owner)[0] + charge(d.__dict__['_OrderedDict__root'], owner)[0]
+                for link in links.itervalues():
+                    size += charge(link, owner)[0]
+            for key in d:
+                size += deep(key, owner)
+
+        return size
+
+    def attribute(attr, owner, weight):
+        if isinstance(attr, Attribute):
+            size = state(attr, owner, ('_observers',))
+            report.attributeTypes[attr.__class__.__name__] += size * weight
+        else:
+            size = deep(attr, owner)
+            report.attributeTypes['raw'] += size * weight
+
+        return size
+
+    def sampleChildren(element):
+        children = element.children.items()
+        if not sample or len(children) <= sample:
+            return (children, 1.0)
+
+        report.sampled = True
+        return (rand.sample(children, sample), float(len(children)) / sample)
+
+    def walk(element, owner, weight, recurse = True):
+        size = state(element, owner, kFlatElementState)
+        size += elementDict(element.attributes, owner) + elementDict(element.children, owner)
+        for attr in element.attributes.itervalues():
+            size += attribute(attr, owner, weight)
+        report.types[element.getTypeName()] += size * weight
+
+        if recurse:
+            (children, scale) = sampleChildren(element)
+            size += scale * sum(walk(child, owner, weight * scale) for (key, child) in children)
+
+        if isinstance(element, Parameter):
+            report.parameterTypes[str(element.attributes[kTypeTag])] += size * weight
+
+        return size
+
+    report.total = walk(mtlx, kMemoryRootOwner, 1.0, False)
+
+    (children, scale) = sampleChildren(mtlx)
+    for (owner, (key, child)) in enumerate(children):
+        size = walk(child, owner, scale)
+        report.elements.append((key, child.getTypeName(), size))
+        report.total += size * scale
+
+    return report
+
+#
+# Builds elements in bulk from column-oriented data. Each element class is
+# constructed once through its constructor to get a template, new elements
+# copy the template's attribute state and only set the given values,
+# skipping the per-object constructors and the change tracking of their
+# still unobserved dicts. The trees built are the same as with the
+# per-object API.
+#
+# With pauseCollection, the build methods also disable the cyclic garbage
+# collector for their own duration, restoring it on return. It otherwise
+# runs over and over as the new containers pile up, without anything to
+# free. The switch is process wide, so other threads also run without
+# collection while a build is in progress, which is why it is opt-in.
+class MaterialXBuilder(object):
+
+    def __init__(self, pauseCollection = False):
+        self.pauseCollection = pauseCollection
+        self.__templates = {}
+
+    def __template(self, elementType):
+        template = self.__templates.get(elementType)
+        if template is None:
+            template = []
+            for (key, attr) in elementType().attributes.iteritems():
+                if isinstance(attr, Attribute):
+                    template.append((key, attr.__class__, attr.__dict__))
+                else:
+                    template.append((key, None, attr))
+            self.__templates[elementType] = template = tuple(template)
+
+        return template
+
+    # New elements are not observed yet, so their items go straight to the
+    # OrderedDict methods instead of through ElementDict.
+    def create(self, elementType, values, children = (), setitem = collections.OrderedDict.__setitem__):
+        element = elementType.__new__(elementType)
+        element.attributes = attributes = ElementDict()
+        element.children = elementChildren = ElementDict()
+
+        for (key, attrType, state) in self.__templates.get(elementType) or self.__template(elementType):
+            if attrType is None:
+                setitem(attributes, key, values.get(key, state))
+            else:
+                attr = attrType.__new__(attrType)
+                d = attr.__dict__
+                d.update(state)
+                if key in values:
+                    d['value'] = values[key]
+                setitem(attributes, key, attr)
+
+        for (key, child) in children:
+            setitem(elementChildren, key, child)
+
+        return element
+
+    @contextlib.contextmanager
+    def __paused(self):
+        enabled = gc.isenabled()
+        if self.pauseCollection:
+            gc.disable()
+        try:
+            yield
+        finally:
+            if enabled:
+                gc.enable()
+
+    # shaders: columns 'name', 'shadertype', 'shaderprogram'.
+    # parameters: columns 'shader' (row in shaders), 'name', 'type', 'value'.
+    # coshaders: columns 'shader', 'name', 'source' (shader name), optional
+    # 'aovset'. Returns the shaders, added to mtlx when given.
+    def buildShaders(self, shaders, parameters = None, coshaders = None, mtlx = None):
+        names = shaders[kNameTag]
+        aovsets = None
+        if coshaders is not None:
+            aovsets = coshaders.get(kAOVSetTag)
+            if aovsets is None:
+                aovsets = [None] * len(coshaders[kNameTag])
+
+        with self.__paused():
+            children = [[] for name in names]
+            if parameters is not None:
+                for (shader, name, ptype, value) in zip(parameters['shader'], parameters[kNameTag],
+                        parameters[kTypeTag], parameters[kValueTag]):
+                    children[shader].append((name, self.create(Parameter, {kNameTag : name, kTypeTag : ptype, kValueTag : value})))
+
+            if coshaders is not None:
+                for (shader, name, source, aovset) in zip(coshaders['shader'], coshaders[kNameTag], coshaders['source'], aovsets):
+                    children[shader].append((name, self.create(CoShader, {kNameTag : name, kShaderTag : source, kAOVSetTag : aovset})))
+
+            result = [self.create(Shader, {kNameTag : name, 'shadertype' : shaderType, 'shaderprogram' : shaderProgram}, shaderChildren)
+                for (name, shaderType, shaderProgram, shaderChildren) in zip(names, shaders['shadertype'], shaders['shaderprogram'], children)]
+
+            if mtlx is not None:
+                mtlx.children.update(zip(names, result))
+
+        return result
+
+    # materials: columns 'name', 'shader' (shader name), optional 'shadingtype'.
+    def buildMaterials(self, materials, mtlx = None):
+        names = materials[kNameTag]
+        shadingTypes = materials.get('shadingtype')
+        if shadingTypes is None:
+            shadingTypes = ['surface'] * len(names)
+
+        with self.__paused():
+            result = [self.create(Material, {kNameTag : name},
+                    ((shaderName, self.create(ShaderRef, {kNameTag : shaderName, 'shadingType' : shadingType})),))
+                for (name, shaderName, shadingType) in zip(names, materials[kShaderTag], shadingTypes)]
+
+            if mtlx is not None:
+                mtlx.children.update(zip(names, result))
+
+        return result
+
 ###############################################################################
 
+#
+def createTestMaterialX(shaderCount = 2):
+    mtlx = MaterialX()
+
+    for i in xrange(shaderCount):
+        shaderName = 'lambert%d' % (i + 1)
+        shader = Shader(shaderName, 'surface', 'lambert')
+        shader.children['color'] = Parameter('color', kColor3Tag, '0.5,0.3,0.%d' % i)
+        shader.children['diffuse'] = Parameter('diffuse', kFloatTag, '0.8')
+        shader.attributes['xpos'].value = float(i)
+        mtlx.children[shaderName] = shader
+
+        materialName = shaderName + 'SG'
+        material = Material(materialName)
+        material.children[shaderName] = ShaderRef(shaderName, 'surface')
+        mtlx.children[materialName] = material
+
+    look = Look('lookA')
+    assign = MaterialAssign('lambert1SG')
+    assign.attributes[kCollectionTag].value = 'xyzCol'
+    look.children['lambert1SG'] = assign
+    mtlx.children['lookA'] = look
+
+    return mtlx
+
+#
+def createBuilderColumns(shaderCount, parameterCount = 4):
+    shaders = {kNameTag : [], 'shadertype' : [], 'shaderprogram' : []}
+    parameters = {'shader' : [], kNameTag : [], kTypeTag : [], kValueTag : []}
+    coshaders = {'shader' : [], kNameTag : [], 'source' : [], kAOVSetTag : []}
+    materials = {kNameTag : [], kShaderTag : []}
+
+    for i in xrange(shaderCount):
+        name = 'shader%d' % i
+        shaders[kNameTag].append(name)
+        shaders['shadertype'].append('surface')
+        shaders['shaderprogram'].append('lambert')
+        for j in xrange(parameterCount):
+            parameters['shader'].append(i)
+            parameters[kNameTag].append('param%d' % j)
+            parameters[kTypeTag].append(kFloatTag)
+            parameters[kValueTag].append(str(j * 0.5))
+        if i > 0:
+            coshaders['shader'].append(i)
+            coshaders[kNameTag].append('incandescence')
+            coshaders['source'].append('shader%d' % (i - 1))
+            coshaders[kAOVSetTag].append('outColor')
+        materials[kNameTag].append(name + 'SG')
+        materials[kShaderTag].append(name)
+
+    return (shaders, parameters, coshaders, materials)
+
+def buildPerObject(shaders, parameters, coshaders, materials):
+    mtlx = MaterialX()
+    result = []
+    for (name, shaderType, shaderProgram) in zip(shaders[kNameTag], shaders['shadertype'], shaders['shaderprogram']):
+        result.append(Shader(name, shaderType, shaderProgram))
+    for (shader, name, ptype, value) in zip(parameters['shader'], parameters[kNameTag], parameters[kTypeTag], parameters[kValueTag]):
+        result[shader].children[name] = Parameter(name, ptype, value)
+    for (shader, name, source, aovset) in zip(coshaders['shader'], coshaders[kNameTag], coshaders['source'], coshaders[kAOVSetTag]):
+        result[shader].children[name] = CoShader(name, source, aovset)
+    for shader in result:
+        mtlx.children[shader.attributes[kNameTag].value] = shader
+    for (name, shaderName) in zip(materials[kNameTag], materials[kShaderTag]):
+        material = Material(name)
+        material.children[shaderName] = ShaderRef(shaderName, 'surface')
+        mtlx.children[name] = material
+
+    return mtlx
+
+def buildBulk(shaders, parameters, coshaders, materials):
+    mtlx = MaterialX()
+    builder = MaterialXBuilder()
+    builder.buildShaders(shaders, parameters, coshaders, mtlx)
+    builder.buildMaterials(materials, mtlx)
+
+    return mtlx
+
+# Both paths run under the same garbage collector setting, first with the
+# collector enabled, then with it paused around the whole build.
+def benchmarkBuilder(shaderCount = 20000, parameterCount = 4):
+    columns = createBuilderColumns(shaderCount, parameterCount)
+    elementCount = shaderCount * (parameterCount + 3) - 1
+    enabled = gc.isenabled()
+
+    try:
+        for collect in (True, False):
+            for (title, build) in (('per-object', buildPerObject), ('bulk', buildBulk)):
+                gc.collect()
+                if collect:
+                    gc.enable()
+                else:
+                    gc.disable()
+                start = time.time()
+                build(*columns)
+                seconds = time.time() - start
+                print '%-12s %-10s %8d elements %8.3f s %10.0f elements/s' % (title, 'gc' if collect else 'gc paused',
+                    elementCount, seconds, elementCount / seconds)
+    finally:
+        if enabled:
+            gc.enable()
+
 #
 class AttributesTest(unittest.TestCase):
 
@@ -908,5 +3016,727 @@ class MaterialXTest(unittest.TestCase):
         data = self.__testOutput()
         self.__testInput(data)
 
+#
+class PicklingTest(unittest.TestCase):
+
+    def testFlatten(self):
+        mtlx = createTestMaterialX()
+        (types, strings, values, structure) = flattenElement(mtlx)
+        self.assertIn(Shader, types)
+        self.assertEqual(strings.count('surface'), 1)
+        self.assertEqual(str(unflattenElement((types, strings, values, structure))), str(mtlx))
+
+    def testPickle(self):
+        mtlx = createTestMaterialX(10)
+
+        data = pickle.dumps(mtlx, pickle.HIGHEST_PROTOCOL)
+        copy = pickle.loads(data)
+        self.assertIsInstance(copy, MaterialX)
+        self.assertIsInstance(copy.children['lambert1'].attributes['xpos'], FloatAttribute)
+        self.assertEqual(str(copy), str(mtlx))
+
+        attr = pickle.loads(pickle.dumps(Vector2Attribute('uv', True, [0.5, 0.25]), pickle.HIGHEST_PROTOCOL))
+        self.assertIsInstance(attr, Vector2Attribute)
+        self.assertEqual(str(attr), '0.5,0.25')
+
+    def testCopy(self):
+        mtlx = createTestMaterialX()
+        shader = mtlx.children['lambert1']
+        query = ElementQuery(mtlx)
+
+        shallow = copy.copy(shader)
+        self.assertIs(shallow.__class__, Shader)
+        self.assertIs(shallow.attributes, shader.attributes)
+        self.assertIs(shallow.children, shader.children)
+        self.assertIsNone(shallow._observers)
+        query.close()
+
+        deep = copy.deepcopy(shader)
+        self.assertIsNot(deep.attributes, shader.attributes)
+        self.assertEqual(flattenElement(deep), flattenElement(shader))
+
+    def testSharedMaterialX(self):
+        mtlx = createTestMaterialX()
+        shared = SharedMaterialX(mtlx)
+        try:
+            handle = pickle.loads(pickle.dumps(shared))
+            self.assertEqual(str(handle.attach()), str(mtlx))
+            self.assertIs(handle.attach(), handle.attach())
+        finally:
+            shared.unlink()
+
+        self.assertFalse(os.path.exists(shared.path))
+
+        with SharedMaterialX(mtlx) as shared:
+            self.assertTrue(os.path.exists(shared.path))
+            self.assertEqual(str(shared.attach()), str(mtlx))
+
+        self.assertFalse(os.path.exists(shared.path))
+
+#
+class ExecutorTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        for name in os.listdir(self.directory):
+            os.remove(os.path.join(self.directory, name))
+        os.rmdir(self.directory)
+
+    def __writeDocuments(self, count):
+        paths = []
+        for i in xrange(count):
+            path = os.path.join(self.directory, 'doc%d.mtlx' % i)
+            createTestMaterialX(i + 1).write(path)
+            paths.append(path)
+
+        return paths
+
+    def testReadWrite(self):
+        mtlx = createTestMaterialX()
+        path = os.path.join(self.directory, 'a.mtlx')
+        mtlx.write(path)
+        self.assertEqual(str(loadMaterialX(path)), str(mtlx))
+
+    def testGatherLoad(self):
+        paths = self.__writeDocuments(6)
+        expected = [str(loadMaterialX(path)) for path in paths]
+
+        self.assertEqual([str(m) for m in gatherLoad(paths, 3, 2)], expected)
+        self.assertEqual([str(m) for m in gatherLoad(paths, 2, 4, processes = 2)], expected)
+
+    def testErrorAndCancel(self):
+        paths = self.__writeDocuments(4)
+
+        executor = MaterialXExecutor(1)
+        missing = executor.load(os.path.join(self.directory, 'missing.mtlx'))
+        self.assertRaises(IOError, missing.result)
+
+        futures = [executor.load(path) for path in paths]
+        executor.close(cancel = True)
+
+        for future in futures:
+            self.assertTrue(future.done())
+            if future.cancelled():
+                self.assertRaises(CancelledError, future.result)
+            else:
+                self.assertIsInstance(future.result(), MaterialX)
+
+#
+class OpGraphTest(unittest.TestCase):
+
+    kOpGraph = '''<?xml version="1.0" ?>
+<materialx version="1.0">
+	<opgraph name="checker">
+		<constant name="base" type="color3">
+			<parameter name="value" type="color3" value="0.2,0.4,0.6"/>
+		</constant>
+		<multiply name="dark" type="color3">
+			<input name="in1" type="color3" nodename="base"/>
+			<parameter name="in2" type="float" value="0.5"/>
+		</multiply>
+		<texcoord name="uv" type="vector2"/>
+		<dotproduct name="ramp" type="float">
+			<input name="in1" type="vector2" nodename="uv"/>
+			<parameter name="in2" type="vector2" value="0.5,0.5"/>
+		</dotproduct>
+		<mix name="blend" type="color3">
+			<input name="fg" type="color3" nodename="base"/>
+			<input name="bg" type="color3" nodename="dark"/>
+			<input name="mix" type="float" nodename="ramp"/>
+		</mix>
+		<dotproduct name="ramp2" type="float">
+			<parameter name="in1" type="vector2" value="0.5,0.5"/>
+			<input name="in2" type="vector2" nodename="uv"/>
+		</dotproduct>
+		<subtract name="zero" type="float">
+			<input name="in1" type="float" nodename="ramp"/>
+			<input name="in2" type="float" nodename="ramp2"/>
+		</subtract>
+		<output name="out" type="color3" nodename="blend"/>
+		<output name="outFlat" type="color3" nodename="dark"/>
+		<output name="outZero" type="float" nodename="zero"/>
+	</opgraph>
+</materialx>
+'''
+
+    def testLoad(self):
+        mtlx = parseMaterialX(self.kOpGraph)
+        opGraph = mtlx.children['checker']
+        self.assertIsInstance(opGraph, OpGraph)
+        self.assertIsInstance(opGraph.children['base'], Constant)
+        self.assertIsInstance(opGraph.children['dark'], OpNode)
+        self.assertEqual(opGraph.children['dark'].getTypeName(), 'multiply')
+        self.assertIsInstance(opGraph.children['out'], Output)
+        self.assertEqual(str(parseMaterialX(str(mtlx))), str(mtlx))
+        self.assertEqual(str(unflattenElement(flattenElement(mtlx))), str(mtlx))
+
+    @unittest.skipIf(numpy is None, 'requires numpy')
+    def testEvaluate(self):
+        program = parseMaterialX(self.kOpGraph).children['checker'].compile()
+
+        # Folded 'dark', shared 'ramp'/'ramp2', leaving dotproduct, mix and subtract.
+        self.assertTrue(program.isConstant(program.outputs['outFlat'][0]))
+        self.assertEqual(len(program.instructions), 3)
+
+        uv = numpy.array([[0.0, 0.0], [1.0, 1.0], [0.5, 0.5]])
+        result = program.evaluate(texcoord = uv)
+
+        base = numpy.array([0.2, 0.4, 0.6])
+        ramp = uv.sum(axis = 1, keepdims = True) * 0.5
+        self.assertTrue(numpy.allclose(result['out'], base * ramp + base * 0.5 * (1.0 - ramp)))
+        self.assertTrue(numpy.allclose(result['outFlat'], numpy.tile(base * 0.5, (3, 1))))
+        self.assertEqual(result['outZero'].shape, (3, 1))
+        self.assertTrue(numpy.allclose(result['outZero'], 0.0))
+
+    @unittest.skipIf(numpy is None, 'requires numpy')
+    def testInvalidGraphs(self):
+        data = self.kOpGraph.replace('<output name="out" type="color3" nodename="blend"/>', '<output name="out" type="float" nodename="blend"/>')
+        with self.assertRaisesRegexp(ValueError, 'output out of type float cannot take the 3 channels of node blend'):
+            parseMaterialX(data).children['checker'].compile()
+
+        data = self.kOpGraph.replace('<input name="in1" type="float" nodename="ramp"/>', '<input name="in1" type="float" nodename="zero"/>')
+        with self.assertRaisesRegexp(ValueError, 'cycle in opgraph at zero'):
+            parseMaterialX(data).children['checker'].compile()
+
+        data = self.kOpGraph.replace('<input name="in1" type="vector2" nodename="uv"/>', '<input name="in1" type="vector2" nodename="base"/>')
+        with self.assertRaisesRegexp(ValueError, 'mismatched input channels 3, 2 for node ramp'):
+            parseMaterialX(data).children['checker'].compile()
+
+        data = self.kOpGraph.replace('<output name="out" type="color3" nodename="blend"/>', '<output name="out" type="color3" nodename="ramp"/>')
+        self.assertEqual(parseMaterialX(data).children['checker'].compile().evaluate(texcoord = numpy.zeros((2, 2)))['out'].shape, (2, 3))
+
+        program = parseMaterialX(self.kOpGraph).children['checker'].compile()
+        with self.assertRaisesRegexp(ValueError, 'missing texcoord samples'):
+            program.evaluate(position = numpy.zeros((2, 3)))
+
+    @unittest.skipIf(numpy is None, 'requires numpy')
+    def testUnsupportedOperator(self):
+        data = self.kOpGraph.replace('<texcoord name="uv" type="vector2"/>', '<noise2d name="uv" type="vector2"/>')
+        opGraph = parseMaterialX(data).children['checker']
+        with self.assertRaisesRegexp(ValueError, 'noise2d at node uv'):
+            opGraph.compile()
+
+#
+@unittest.skipIf(numpy is None, 'requires numpy')
+class ParameterTableTest(unittest.TestCase):
+
+    def __createLibrary(self):
+        mtlxs = [createTestMaterialX(3), createTestMaterialX(2)]
+        mtlxs[0].children['lambert2'].children['roughness'] = Parameter('roughness', kFloatTag, '0.9')
+        mtlxs[1].children['lambert1'].children['roughness'] = Parameter('roughness', kFloatTag, '0.2')
+        mtlxs[1].children['lambert2'].children['texture'] = Parameter('texture', kFilenameTag, 'wood.tx')
+
+        return mtlxs
+
+    def __checkTable(self, table):
+        self.assertEqual(len(table.shaders), 5)
+        self.assertEqual(list(table.shaders['document']), [0, 0, 0, 1, 1])
+
+        (rows, values) = table.parameterValues('roughness')
+        shaders = table.parameters['shader'][rows[values[:, 0] > 0.8]]
+        self.assertEqual(table.shaderNames(shaders), ['lambert2'])
+        self.assertEqual(list(table.shaders['document'][shaders]), [0])
+
+        (rows, colors) = table.parameterValues('color', 3)
+        self.assertEqual(colors.shape, (5, 3))
+        self.assertTrue(numpy.allclose(colors[:, 2], [0.0, 0.1, 0.2, 0.0, 0.1]))
+
+        row = numpy.flatnonzero(table.parameters['name'] == table.stringId('texture'))[0]
+        self.assertEqual(table.parameters['count'][row], 0)
+        self.assertEqual(table.strings[table.parameters['string'][row]], 'wood.tx')
+
+    def testExport(self):
+        self.__checkTable(ParameterTable.fromMaterialX(self.__createLibrary()))
+
+    def testSaveLoad(self):
+        (fd, path) = tempfile.mkstemp('.mxscol')
+        os.close(fd)
+        try:
+            ParameterTable.fromMaterialX(self.__createLibrary()).save(path)
+            table = ParameterTable.load(path)
+            self.assertIsInstance(table.values, numpy.memmap)
+            self.__checkTable(table)
+            self.__checkTable(ParameterTable.load(path, mmap = False))
+            del table
+        finally:
+            os.remove(path)
+
+#
+class ComposeTest(unittest.TestCase):
+
+    def testReplacedProvenance(self):
+        base = MaterialX()
+        base.children['x'] = Shader('x', 'surface', 'lambert')
+        base.children['x'].children['q'] = Parameter('q', kFloatTag, '0.5')
+        base.children['x'].attributes['xpos'].value = 1.0
+        override = MaterialX()
+        override.children['x'] = Shader('x')
+        override.children['x'].attributes['xpos'].value = 2.0
+        override.children['x'].children['q'] = Parameter('q', kFloatTag, '0.7')
+        replacement = MaterialX()
+        replacement.children['x'] = Material('x')
+
+        composition = composeMaterialX([MaterialX(), base, override, replacement])
+        self.assertIsInstance(composition.mtlx.children['x'], Material)
+        self.assertEqual(composition.layerOf(('x',)), 3)
+        self.assertEqual(composition.layerOf(('x', 'q')), 3)
+        self.assertEqual(composition.attributeLayerOf(('x',), 'xpos'), 3)
+        self.assertNotIn(('x', 'q'), composition.provenance)
+        self.assertEqual(composition.attributeProvenance, {})
+
+    def testCompose(self):
+        library = createTestMaterialX(3)
+        asset = MaterialX()
+        asset.children['lambert1'] = Shader('lambert1', 'surface', 'lambert')
+        asset.children['lambert1'].children['color'] = Parameter('color', kColor3Tag, '1,0,0')
+        asset.children['lambert1'].attributes['xpos'].value = 10.0
+        asset.children['lambert2'] = createTestMaterialX(3).children['lambert2']
+        asset.children['blinn1'] = Shader('blinn1', 'surface', 'blinn')
+        shot = MaterialX()
+        shot.children['lambert1'] = Shader('lambert1')
+        shot.children['lambert1'].children['diffuse'] = Parameter('diffuse', kFloatTag, '0.2')
+
+        libraryData = str(library)
+        composition = composeMaterialX([library, asset, shot])
+        mtlx = composition.mtlx
+        self.assertEqual(str(library), libraryData)
+
+        lambert1 = mtlx.children['lambert1']
+        self.assertEqual(lambert1.attributes['shaderprogram'].value, 'lambert')
+        self.assertEqual(lambert1.attributes['xpos'].value, 10.0)
+        self.assertEqual(lambert1.children['color'].attributes[kValueTag], '1,0,0')
+        self.assertEqual(lambert1.children['diffuse'].attributes[kValueTag], '0.2')
+        self.assertEqual(mtlx.children.keys(), library.children.keys() + ['blinn1'])
+
+        # Unchanged and identical subtrees are shared with the weakest layer.
+        self.assertIs(mtlx.children['lambert2'], library.children['lambert2'])
+        self.assertIs(mtlx.children['lambert3SG'], library.children['lambert3SG'])
+        self.assertIs(mtlx.children['blinn1'], asset.children['blinn1'])
+
+        self.assertEqual(composition.layerOf(('lambert1',)), 0)
+        self.assertEqual(composition.layerOf(('lambert1', 'color')), 1)
+        self.assertEqual(composition.layerOf(('lambert1', 'diffuse')), 2)
+        self.assertEqual(composition.layerOf(('lambert2', 'color')), 0)
+        self.assertEqual(composition.layerOf(('blinn1',)), 1)
+        self.assertEqual(composition.attributeLayerOf(('lambert1',), 'xpos'), 1)
+        self.assertEqual(composition.attributeLayerOf(('lambert1',), 'shaderprogram'), 0)
+
+        # Merged elements own their attributes.
+        lambert1.attributes['shaderprogram'].value = 'phong'
+        lambert1.attributes['xpos'].value = 20.0
+        self.assertEqual(library.children['lambert1'].attributes['shaderprogram'].value, 'lambert')
+        self.assertEqual(asset.children['lambert1'].attributes['xpos'].value, 10.0)
+
+#
+class ElementQueryTest(unittest.TestCase):
+
+    def setUp(self):
+        self.mtlx = createTestMaterialX(4)
+        self.mtlx.children['blinn1'] = Shader('blinn1', 'surface', 'blinn')
+        self.mtlx.children['blinn1'].children['color'] = Parameter('color', kColor3Tag, '1,1,1')
+        self.query = ElementQuery(self.mtlx)
+
+    def __names(self, elements):
+        return [str(e.attributes[kNameTag]) for e in elements]
+
+    def testParse(self):
+        steps = parseSelector('look > materialassign[collection="xyz Col"][name=lambert*]')
+        self.assertEqual(steps, [(kSelectorDescendant, 'look', []),
+            (kSelectorChild, 'materialassign', [('collection', '=', 'xyz Col', False), ('name', '=', 'lambert*', True)])])
+        self.assertRaises(ValueError, parseSelector, 'shader[name=a] ]')
+        self.assertRaises(ValueError, parseSelector, 'shader[bogus]')
+        self.assertRaises(ValueError, parseSelector, 'shader[name~foo]')
+        self.assertRaises(ValueError, parseSelector, 'shader[name=a][bogus]')
+
+    def testSelect(self):
+        q = self.query
+        self.assertEqual(self.__names(q.select('shader[shaderprogram=lambert]')), ['lambert1', 'lambert2', 'lambert3', 'lambert4'])
+        self.assertEqual(self.__names(q.select('shader[name=*1]')), ['lambert1', 'blinn1'])
+        self.assertEqual(len(q.select('shader[shadertype=surface] parameter[type=color3]')), 5)
+        self.assertEqual(len(q.select('shader[shaderprogram=blinn] > parameter')), 1)
+        self.assertEqual(self.__names(q.select('shader[xpos>=2]')), ['lambert3', 'lambert4'])
+        self.assertEqual(self.__names(q.select('look > materialassign[collection=xyzCol]')), ['lambert1SG'])
+        self.assertEqual(q.select('material > parameter'), [])
+        self.assertEqual(len(q.select('*')), 1 + 4 * 5 + 2 + 2)
+        self.assertIs(q.first('materialx'), self.mtlx)
+
+    def testIncrementalIndexes(self):
+        q = self.query
+        q.select('shader[shaderprogram=lambert]')
+        typeIndex = q.typeIndex()
+        programIndex = q.attributeIndex('shaderprogram')
+        nameIndex = q.attributeIndex(kNameTag)
+
+        # An attribute value change moves its element within that index.
+        self.mtlx.children['lambert2'].attributes['shaderprogram'].value = 'blinn'
+        self.assertEqual(len(programIndex['lambert']), 3)
+        self.assertEqual(self.__names(q.select('shader[shaderprogram=blinn]')), ['lambert2', 'blinn1'])
+
+        self.mtlx.children['lambert2'].attributes['shaderprogram'] = StringAttribute('shaderprogram', True, 'phong')
+        self.assertEqual(self.__names(q.select('shader[shaderprogram=phong]')), ['lambert2'])
+        self.assertEqual(self.__names(programIndex['blinn'].values()), ['blinn1'])
+
+        # Structural changes add and remove only their own elements.
+        parameterCount = len(typeIndex[kParameterTag])
+        self.mtlx.children['lambert3'].children['specular'] = Parameter('specular', kFloatTag, '0.5')
+        self.assertEqual(len(typeIndex[kParameterTag]), parameterCount + 1)
+        self.assertEqual(len(q.select('shader > parameter[name=specular]')), 1)
+
+        shader = Shader('phong1', 'surface', 'phong')
+        shader.children['color'] = Parameter('color', kColor3Tag, '1,0,0')
+        self.mtlx.children['phong1'] = shader
+        self.assertEqual(self.__names(q.select('shader[shaderprogram=phong]')), ['lambert2', 'phong1'])
+        self.assertEqual(len(typeIndex[kParameterTag]), parameterCount + 2)
+        shader.attributes['shaderprogram'].value = 'lambert'
+        self.assertEqual(self.__names(q.select('shader[shaderprogram=lambert]')), ['lambert1', 'lambert3', 'lambert4', 'phong1'])
+
+        del self.mtlx.children['lambert1']
+        self.assertEqual(self.__names(q.select('shader[shaderprogram=lambert]')), ['lambert3', 'lambert4', 'phong1'])
+        self.assertEqual(len(typeIndex[kParameterTag]), parameterCount)
+        self.mtlx.children['lambert1'] = Shader('lambert1', 'surface', 'lambert')
+        self.assertEqual(self.__names(q.select('shader[shaderprogram=lambert]')), ['lambert3', 'lambert4', 'phong1', 'lambert1'])
+
+        self.assertIs(q.typeIndex(), typeIndex)
+        self.assertIs(q.attributeIndex('shaderprogram'), programIndex)
+        self.assertIs(q.attributeIndex(kNameTag), nameIndex)
+
+        q.close()
+        self.assertIsNone(self.mtlx._observers)
+        self.assertEqual(len(typeIndex), 0)
+        self.assertEqual(len(nameIndex), 0)
+
+    def testUnobservedCost(self):
+        enabled = gc.isenabled()
+        gc.disable()
+        try:
+            shader = Shader('lambert1')
+            ref = weakref.ref(shader)
+            del shader
+            self.assertIsNone(ref())
+        finally:
+            if enabled:
+                gc.enable()
+
+        # Observing leaves the types of attributes and dicts alone.
+        shader = self.mtlx.children['lambert1']
+        attr = shader.attributes['xpos']
+        self.assertIs(type(attr), FloatAttribute)
+        self.assertIs(type(shader.children), ElementDict)
+        self.assertIsNotNone(shader.children._owner)
+
+        self.query.close()
+        self.assertIs(type(attr), FloatAttribute)
+        self.assertIsNone(shader.children._owner)
+        self.assertNotIn('_observers', shader.__dict__)
+
+#
+class ContainerTest(unittest.TestCase):
+
+    def setUp(self):
+        (fd, self.path) = tempfile.mkstemp('.mtlxz')
+        os.close(fd)
+
+    def tearDown(self):
+        os.remove(self.path)
+
+    def testContainer(self):
+        mtlx = createTestMaterialX(50)
+        data = str(mtlx)
+
+        for codec in kContainerCodecs:
+            mtlx.write(self.path, codec, 1024)
+            self.assertLess(os.path.getsize(self.path), len(data) / 2)
+            self.assertEqual(str(loadMaterialX(self.path)), data)
+
+            with open(self.path, 'rb') as f:
+                self.assertEqual(str(parseMaterialX(f.read())), data)
+
+            with MaterialXContainer(self.path) as container:
+                self.assertEqual(container.codec, codec)
+                self.assertEqual(container.names(), mtlx.children.keys())
+                self.assertGreater(len(container.chunks), 1)
+
+                shader = container.readElement('lambert42')
+                self.assertIsInstance(shader, Shader)
+                self.assertEqual(shader.children['color'].attributes[kValueTag], '0.5,0.3,0.41')
+
+    def testKeys(self):
+        mtlx = MaterialX()
+        mtlx.children['key1'] = Shader('realname', 'surface', 'lambert')
+        mtlx.children['key2'] = Shader('key1', 'surface', 'blinn')
+        mtlx.write(self.path, 'zlib')
+
+        with MaterialXContainer(self.path) as container:
+            self.assertEqual(container.names(), ['key1', 'key2'])
+            self.assertEqual(str(container.readElement('key1').attributes['shaderprogram']), 'lambert')
+            self.assertEqual(str(container.readElement('key2').attributes['shaderprogram']), 'blinn')
+
+    def testEmpty(self):
+        MaterialX().write(self.path, 'zlib')
+        self.assertEqual(str(loadMaterialX(self.path)), str(MaterialX()))
+
+#
+class ChangeStreamTest(unittest.TestCase):
+
+    def setUp(self):
+        self.mtlx = createTestMaterialX(3)
+        self.batches = []
+
+    def testTransaction(self):
+        stream = ChangeStream(self.mtlx)
+        stream.subscribe(self.batches.append)
+
+        diffuse = self.mtlx.children['lambert1'].children['diffuse']
+        with stream.transaction():
+            for i in xrange(1000):
+                diffuse.attributes[kValueTag] = str(i / 1000.0)
+            self.mtlx.children['lambert2'].attributes['xpos'].value = 5.0
+            self.assertEqual(self.batches, [])
+
+        self.assertEqual(self.batches, [[
+            ChangeEvent(kAttributeSet, ('lambert1', 'diffuse'), kValueTag, '0.999'),
+            ChangeEvent(kAttributeSet, ('lambert2',), 'xpos', 5.0)]])
+
+        stream.close()
+        diffuse.attributes[kValueTag] = '0.1'
+        self.assertEqual(stream.flush(), [])
+
+    def testStructure(self):
+        stream = ChangeStream(self.mtlx)
+        stream.subscribe(self.batches.append)
+
+        # Added then removed cancels out, changes inside a removed element fold.
+        temp = Shader('temp')
+        self.mtlx.children['temp'] = temp
+        temp.attributes['xpos'].value = 1.0
+        temp.children['p'] = Parameter('p', kFloatTag, '1')
+        del self.mtlx.children['temp']
+        self.mtlx.children['lambert3'].children['color'].attributes[kValueTag] = '1,1,1'
+        del self.mtlx.children['lambert3']
+
+        shader = Shader('blinn1', 'surface', 'blinn')
+        self.mtlx.children['blinn1'] = shader
+        shader.children['color'] = Parameter('color', kColor3Tag, '0,0,0')
+        self.assertEqual(stream.flush(), [
+            ChangeEvent(kElementRemoved, ('lambert3',), None, None),
+            ChangeEvent(kElementAdded, ('blinn1',), None, shader)])
+
+        # New elements are observed at their path.
+        shader.children['color'].attributes[kValueTag] = '1,0,0'
+        shader.attributes['shaderprogram'] = StringAttribute('shaderprogram', True, 'phong')
+        shader.attributes['shaderprogram'].value = 'lambert'
+        self.assertEqual(stream.flush(), [
+            ChangeEvent(kAttributeSet, ('blinn1', 'color'), kValueTag, '1,0,0'),
+            ChangeEvent(kAttributeSet, ('blinn1',), 'shaderprogram', 'lambert')])
+        self.assertEqual(len(self.batches), 2)
+
+    def testWindow(self):
+        delivered = threading.Event()
+        stream = ChangeStream(self.mtlx, 0.05)
+        stream.subscribe(lambda events: (self.batches.append(events), delivered.set()))
+
+        for i in xrange(100):
+            self.mtlx.children['lambert1'].attributes['ypos'].value = float(i)
+
+        self.assertTrue(delivered.wait(5.0))
+        self.assertEqual(self.batches, [[ChangeEvent(kAttributeSet, ('lambert1',), 'ypos', 99.0)]])
+
+        stream.window = 0
+        self.mtlx.children['lambert1'].attributes['ypos'].value = 1.0
+        self.mtlx.children['lambert1'].attributes['ypos'].value = 2.0
+        self.assertEqual(len(self.batches), 3)
+        stream.close()
+
+#
+class WatcherTest(unittest.TestCase):
+
+    def setUp(self):
+        (fd, self.path) = tempfile.mkstemp('.mtlx')
+        os.close(fd)
+
+    def tearDown(self):
+        os.remove(self.path)
+
+    def testSplit(self):
+        data = str(createTestMaterialX(2))
+        (head, elements) = splitMaterialXElements(data)
+        self.assertTrue(head.rstrip().endswith('<materialx version="1.0">'))
+        self.assertEqual([name for (name, chunk) in elements], ['lambert1', 'lambert1SG', 'lambert2', 'lambert2SG', 'lookA'])
+        self.assertTrue(elements[0][1].startswith('<shader name="lambert1"'))
+        self.assertTrue(elements[-1][1].rstrip().endswith('</look>'))
+
+    def testReload(self):
+        source = createTestMaterialX(3)
+        source.write(self.path)
+
+        reloads = []
+        watcher = MaterialXWatcher(self.path, callback = lambda changed, removed: reloads.append((changed, removed)))
+        mtlx = watcher.mtlx
+        self.assertEqual(str(mtlx), str(source))
+        lambert1 = mtlx.children['lambert1']
+        lambert2 = mtlx.children['lambert2']
+
+        self.assertEqual(watcher.reload(), ([], []))
+
+        source.children['lambert2'].children['diffuse'].attributes[kValueTag] = '0.1'
+        del source.children['lambert3SG']
+        source.children['blinn1'] = Shader('blinn1', 'surface', 'blinn')
+        source.write(self.path)
+        os.utime(self.path, (0, 0))
+
+        stream = ChangeStream(mtlx, 0)
+        stream.subscribe(lambda events: reloads.append(events))
+        self.assertEqual(watcher.poll(), (['lambert2', 'blinn1'], ['lambert3SG']))
+        self.assertIsNone(watcher.poll())
+        stream.close()
+
+        self.assertEqual(str(mtlx), str(source))
+        self.assertIs(mtlx.children['lambert1'], lambert1)
+        self.assertIsNot(mtlx.children['lambert2'], lambert2)
+        self.assertEqual(mtlx.children['lambert2'].children['diffuse'].attributes[kValueTag], '0.1')
+        self.assertEqual([e.path for e in sum(reloads[1:-1], [])], [('lambert2',), ('blinn1',), ('lambert3SG',)])
+
+        source.write(self.path, 'zlib')
+        self.assertEqual(watcher.reload(), ([], []))
+        self.assertIs(mtlx.children['lambert1'], lambert1)
+
+    def testReorder(self):
+        source = createTestMaterialX(3)
+        source.write(self.path)
+        watcher = MaterialXWatcher(self.path)
+        mtlx = watcher.mtlx
+
+        reordered = MaterialX()
+        reordered.children['blinn1'] = Shader('blinn1', 'surface', 'blinn')
+        reordered.children.update(source.children)
+        reordered.write(self.path)
+
+        stream = ChangeStream(mtlx, 0)
+        events = []
+        stream.subscribe(events.extend)
+        query = ElementQuery(mtlx)
+        self.assertEqual(len(query.select('shader')), 3)
+        self.assertEqual(watcher.reload(), (['blinn1'], []))
+        stream.close()
+
+        self.assertEqual(query.select('shader'), [mtlx.children[name] for name in ('blinn1', 'lambert1', 'lambert2', 'lambert3')])
+        query.close()
+
+        self.assertEqual(events, [ChangeEvent(kElementAdded, ('blinn1',), None, mtlx.children['blinn1']),
+            ChangeEvent(kElementReordered, (), None, reordered.children.keys())])
+        self.assertEqual(mtlx.children.keys(), reordered.children.keys())
+        self.assertEqual(set(type(key) for key in mtlx.children), set([str]))
+        self.assertEqual(str(mtlx), str(reordered))
+
+    def testNonAscii(self):
+        data = ('<?xml version="1.0" encoding="utf-8"?>\n<materialx version="1.0">\n'
+            '\t<shader name="file1" shaderprogram="file" shadertype="texture">\n'
+            '\t\t<parameter name="fileTextureName" type="filename" value="caf\xc3\xa9.tx"/>\n'
+            '\t</shader>\n</materialx>\n')
+        with open(self.path, 'wb') as f:
+            f.write(data)
+
+        def fileName(mtlx):
+            return mtlx.children['file1'].children['fileTextureName'].attributes[kValueTag]
+
+        watcher = MaterialXWatcher(self.path)
+        self.assertEqual(watcher.mtlx.children.keys(), ['file1'])
+        self.assertEqual(fileName(watcher.mtlx), u'caf\xe9.tx')
+        self.assertEqual(fileName(watcher.mtlx), fileName(loadMaterialX(self.path)))
+
+        with open(self.path, 'wb') as f:
+            f.write(data.replace('caf\xc3\xa9', 'th\xc3\xa9'))
+        self.assertEqual(watcher.reload(), (['file1'], []))
+        self.assertEqual(fileName(watcher.mtlx), u'th\xe9.tx')
+
+    def testRetryAfterError(self):
+        createTestMaterialX(1).write(self.path)
+        watcher = MaterialXWatcher(self.path)
+
+        with open(self.path, 'wb') as f:
+            f.write('<materialx version="1.0"><shader name="half"')
+        self.assertRaises(xml.parsers.expat.ExpatError, watcher.poll)
+        self.assertRaises(xml.parsers.expat.ExpatError, watcher.poll)
+
+#
+class MemoryReportTest(unittest.TestCase):
+
+    def testReport(self):
+        mtlx = createTestMaterialX(20)
+        mtlx.children['lambert7'].children['ramp'] = Parameter('ramp', kFloatArrayTag, ','.join(['0.5'] * 500))
+        report = memoryReport(mtlx)
+
+        self.assertFalse(report.sampled)
+        self.assertEqual(len(report.elements), len(mtlx.children))
+        self.assertEqual(report.top(1, kShaderTag)[0][0], 'lambert7')
+        self.assertEqual([e[1] for e in report.top(3, kMaterialTag)], [kMaterialTag] * 3)
+        self.assertGreater(report.total, sum(e[2] for e in report.elements))
+        self.assertGreater(report.parameterTypes[kFloatArrayTag], report.parameterTypes[kFloatTag] / 20)
+        self.assertIn('StringAttribute', report.attributeTypes)
+        self.assertIn('top elements:', str(report))
+
+    def testShared(self):
+        mtlx = createTestMaterialX(2)
+        before = memoryReport(mtlx)
+
+        mtlx.children['alias'] = mtlx.children['lambert1']
+        report = memoryReport(mtlx)
+        self.assertEqual(report.top(1, kShaderTag)[0][0], 'lambert1')
+        self.assertEqual(dict((e[0], e[2]) for e in report.elements)['alias'], 0)
+        self.assertGreater(report.shared, before.shared + report.top(1, kShaderTag)[0][2] / 2)
+
+    def testSampling(self):
+        mtlx = createTestMaterialX(200)
+        report = memoryReport(mtlx)
+        sampled = memoryReport(mtlx, 20)
+
+        self.assertTrue(sampled.sampled)
+        self.assertEqual(len(sampled.elements), 20)
+        self.assertLess(abs(sampled.total - report.total), report.total * 0.2)
+
+#
+class BuilderTest(unittest.TestCase):
+
+    def testBuild(self):
+        columns = createBuilderColumns(30, 3)
+        expected = buildPerObject(*columns)
+        mtlx = buildBulk(*columns)
+
+        self.assertEqual(str(mtlx), str(expected))
+        self.assertEqual(flattenElement(mtlx), flattenElement(expected))
+
+        # Built elements own their attributes and observe like any other.
+        shaders = [mtlx.children['shader0'], mtlx.children['shader1']]
+        self.assertIsNot(shaders[0].attributes['xpos'], shaders[1].attributes['xpos'])
+        stream = ChangeStream(mtlx)
+        shaders[0].attributes['xpos'].value = 1.0
+        shaders[1].children['param0'].attributes[kValueTag] = '2'
+        self.assertEqual(len(stream.flush()), 2)
+        self.assertIsNone(mtlx.children['shader2'].attributes['xpos'].value)
+        stream.close()
+
+        # Collection is only paused when asked to, and restored after.
+        self.assertTrue(gc.isenabled())
+        material = MaterialXBuilder(pauseCollection = True).buildMaterials(columns[3])[0]
+        self.assertEqual(flattenElement(material), flattenElement(expected.children['shader0SG']))
+        self.assertTrue(gc.isenabled())
+
+    @unittest.skipIf(numpy is None, 'requires numpy')
+    def testNumpyColumns(self):
+        (shaders, parameters, coshaders, materials) = createBuilderColumns(5, 2)
+        expected = buildPerObject(shaders, parameters, coshaders, materials)
+
+        parameters['shader'] = numpy.array(parameters['shader'])
+        coshaders[kAOVSetTag] = numpy.array(coshaders[kAOVSetTag], dtype = object)
+        materials['shadingtype'] = numpy.array(['surface'] * len(materials[kNameTag]), dtype = object)
+        mtlx = buildBulk(shaders, parameters, coshaders, materials)
+
+        self.assertEqual(str(mtlx), str(expected))
+
 if __name__ == '__main__':
-    unittest.main()
\ No newline at end of file
+    if sys.argv[1:] == ['benchmark']:
+        benchmarkBuilder()
+    else:
+        unittest.main()
\ No newline at end of file